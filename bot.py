@@ -2,14 +2,21 @@ import logging
 import asyncio
 import json
 import random
+import re
+import signal
+import time
 from io import BytesIO
 
-import telebot
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware
 from telebot import types
 
 # Local imports
-from data import LIBRARY_DATA
+from data import LIBRARY_DATA, RECOMMENDATIONS
 from database import DatabaseManager
+from quiz_sessions import QuizSessionStore, RenderCache
+from recommend import ShuffleBag, recommendation_pool
+from router import Router, parse_choice, parse_int, parse_flag, parse_page
 from utils import generate_profile_card
 
 # ==========================================
@@ -19,16 +26,84 @@ BOT_TOKEN = "7623963043:AAG9INqRwqEa9WhynbN3hkZva6fLISx5ROY"
 ADMIN_ID = 6361665798
 DEV_USERNAME = "bekzodmusayev29"
 BOT_NAME = "@OnlineKitobxonBot"
+DB_READERS = 4  # pooled read connections (plus one writer)
+# "WAL" only once the database sits in a mounted directory: compose mounts
+# the file alone, and the -wal file beside it would be lost on recreate
+DB_JOURNAL_MODE = "DELETE"
+WRITE_DURABILITY = "normal"  # "full", "normal" or "async", see database.WriteQueue
+WRITE_BATCH = 256  # most queued writes committed together
+WRITE_DELAY = 0.005  # seconds a batch waits for more writes to join it
+MAX_CONCURRENT_UPDATES = 64  # updates handled at once on the event loop
+ITEMS_PER_PAGE = 10
+QUIZ_LENGTH = 10  # questions per quiz
+SESSION_TTL = 30 * 60  # idle quiz sessions expire after this many seconds
+MAX_SESSIONS = 10000
+SESSION_CHECKPOINT = 15  # seconds between session checkpoints
+QUIZ_EDIT_IN_PLACE = True  # edit the quiz message instead of delete + send
+INLINE_PAGE = 50  # results per inline answer (Telegram's maximum)
+INLINE_CACHE_TIME = 300  # seconds Telegram may reuse an inline answer
+LEDGER_KEEP_DAYS = 35  # points ledger rows older than this are compacted away
+MAINTENANCE_INTERVAL = 24 * 60 * 60  # ledger compaction and co-read rebuild
+SHUTDOWN_TIMEOUT = 8  # seconds running updates get to finish on stop (docker stop waits 10)
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 
 # Initialize Bot and Database
-bot = telebot.TeleBot(BOT_TOKEN)
-db = DatabaseManager()
-
-# Quiz Session Storage
-quiz_session = {}
+bot = AsyncTeleBot(BOT_TOKEN)
+db = DatabaseManager(readers=DB_READERS, durability=WRITE_DURABILITY, write_batch=WRITE_BATCH, write_delay=WRITE_DELAY,
+                     journal_mode=DB_JOURNAL_MODE)
+
+class ConcurrencyLimiter(BaseMiddleware):
+    """Caps how many updates run at once and records handler latency.
+
+    AsyncTeleBot starts a task per update; the semaphore keeps a burst of
+    updates from opening unbounded Bot API requests and DB waits.
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.update_types = ['message', 'callback_query', 'inline_query']
+        self.semaphore = asyncio.Semaphore(limit)
+        self.limit = limit
+        self.active = 0
+        self.peak = 0
+        self.handled = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def pre_process(self, update, data):
+        await self.semaphore.acquire()
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        data['started'] = time.perf_counter()
+
+    async def post_process(self, update, data, exception):
+        elapsed = time.perf_counter() - data['started']
+        self.active -= 1
+        self.handled += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.semaphore.release()
+
+    async def drain(self):
+        """Wait until every running update is done; later ones stay blocked."""
+        for _ in range(self.limit):
+            await self.semaphore.acquire()
+
+limiter = ConcurrencyLimiter(MAX_CONCURRENT_UPDATES)
+bot.setup_middleware(limiter)
+
+# Menu buttons and callback data are dispatched through one table each
+router = Router()
+
+# Quiz Session Storage (checkpointed to SQLite, see session_checkpoint_loop)
+sessions = QuizSessionStore(ttl=SESSION_TTL, max_sessions=MAX_SESSIONS)
+# Pre-rendered (text, keyboard) steps of running quizzes, rebuilt on a miss
+rendered_quizzes = RenderCache(max_entries=MAX_SESSIONS // 4)
+# Curated picks for "🎲 Tasodifiy Kitob", validated once; each user walks
+# their own shuffled order of it (see DatabaseManager.next_in_bag)
+recommendation_bag = ShuffleBag(recommendation_pool(RECOMMENDATIONS))
 
 # ==========================================
 # 2. KEYBOARDS & UI HELPERS
@@ -54,29 +129,26 @@ def main_menu():
     )
     return kb
 
-def get_pagination_kb(page, total_pages, prefix):
+def get_pagination_kb(page, total_pages, prefix, first_id=None, last_id=None):
+    # first_id / last_id travel in the callback so the next page is a keyset seek
     kb = types.InlineKeyboardMarkup(row_width=3)
     row = []
     
     if page > 1:
-        row.append(types.InlineKeyboardButton("⬅️", callback_data=f"{prefix}_prev_{page}"))
+        cursor = f"_{first_id}" if first_id is not None else ""
+        row.append(types.InlineKeyboardButton("⬅️", callback_data=f"{prefix}_prev_{page}{cursor}"))
     
     row.append(types.InlineKeyboardButton(f"📄 {page}/{total_pages}", callback_data="noop"))
     
     if page < total_pages:
-        row.append(types.InlineKeyboardButton("➡️", callback_data=f"{prefix}_next_{page}"))
+        cursor = f"_{last_id}" if last_id is not None else ""
+        row.append(types.InlineKeyboardButton("➡️", callback_data=f"{prefix}_next_{page}{cursor}"))
     
     kb.add(*row)
     return kb
 
-def get_test_page_markup(books, page=1):
-    ITEMS_PER_PAGE = 10
-    total_pages = (len(books) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    
-    start_idx = (page - 1) * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    current_books = books[start_idx:end_idx]
-    
+def get_test_page_markup(current_books, page=1, total_pages=1):
+    # current_books is already the page slice from the catalog cache
     # 1-Column Layout
     kb = types.InlineKeyboardMarkup(row_width=1)
     
@@ -94,14 +166,8 @@ def get_test_page_markup(books, page=1):
     
     return kb
 
-def get_library_page_markup(pdfs, page=1):
-    ITEMS_PER_PAGE = 10
-    total_pages = (len(pdfs) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    
-    start_idx = (page - 1) * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    current_pdfs = pdfs[start_idx:end_idx]
-    
+def get_library_page_markup(current_pdfs, page=1, total_pages=1):
+    # current_pdfs is one page fetched with get_pdfs_page
     # 1-Column Layout
     kb = types.InlineKeyboardMarkup(row_width=1)
     
@@ -113,40 +179,230 @@ def get_library_page_markup(pdfs, page=1):
     
     # Pagination
     if total_pages > 1:
-        nav_kb = get_pagination_kb(page, total_pages, "lib")
+        first_id = current_pdfs[0][0] if current_pdfs else None
+        last_id = current_pdfs[-1][0] if current_pdfs else None
+        nav_kb = get_pagination_kb(page, total_pages, "lib", first_id, last_id)
         for row in nav_kb.keyboard:
             kb.add(*row)
     
     return kb
 
+# --- RENDER CACHE ---
+# Static payloads are serialized once; catalog and library page keyboards are
+# cached as JSON keyed by the data version they were built from.
+MAIN_MENU = main_menu().to_json()
+CATALOG_PROMPT = "📚 <b>Qaysi asar bo'yicha bilimingizni sinamoqchisiz?</b>"
+LIBRARY_PROMPT = "📚 <b>Elektron Kutubxona:</b>\nMarhamat, o'qish uchun kitob tanlang:"
+page_markups = RenderCache(max_entries=512)
+
+async def test_page_payload(page):
+    """Keyboard JSON for a catalog page, or None when there are no books."""
+    if db.catalog.loaded:
+        kb = page_markups.get(("test", db.catalog.version, page))
+        if kb is not None:
+            return kb
+    books, total_pages = await db.get_books_page(page, ITEMS_PER_PAGE)
+    if not books:
+        return None
+    page = min(page, total_pages)
+    kb = get_test_page_markup(books, page, total_pages).to_json()
+    page_markups.put(("test", db.catalog.version, page), kb)
+    return kb
+
+async def library_page_payload(page, after=None, before=None):
+    """Keyboard JSON for a library page, or None when the page is empty."""
+    version = db.library_version
+    kb = page_markups.get(("lib", version, page))
+    if kb is not None:
+        return kb
+    pdfs, total_pages = await db.get_pdfs_page(page, ITEMS_PER_PAGE, after, before)
+    if not pdfs:
+        return None
+    page = max(1, min(page, total_pages))
+    kb = get_library_page_markup(pdfs, page, total_pages).to_json()
+    page_markups.put(("lib", version, page), kb)
+    return kb
+
 # ==========================================
 # 3. HANDLERS
 # ==========================================
 
 @bot.message_handler(commands=['start'])
-def send_welcome(message):
-    asyncio.run(db.add_user(message.from_user.id, message.from_user.full_name))
+async def send_welcome(message):
+    await db.add_user(message.from_user.id, message.from_user.full_name)
     
-    bot.reply_to(
+    await bot.reply_to(
         message,
         f"👋 Assalomu alaykum, {message.from_user.full_name}!\n\n"
         f"🧠 <b>Kitobxon Pro</b> botiga xush kelibsiz.\n"
         f"Bu yerda siz kitoblar asosida bilimingizni sinashingiz, yangi asarlar o'qishingiz va sovg'alar yutishingiz mumkin!",
         parse_mode="HTML",
-        reply_markup=main_menu()
+        reply_markup=MAIN_MENU
     )
+    
+    # Deep link from an inline result: /start book_<id>
+    payload = message.text.split(maxsplit=1)[1] if " " in message.text else ""
+    if payload.startswith("book_") and payload[5:].isdigit():
+        book = await db.get_book(int(payload[5:]))
+        if book:
+            kb = types.InlineKeyboardMarkup()
+            kb.add(types.InlineKeyboardButton("🧠 Testni boshlash", callback_data=f"startquiz_{book[0]}"))
+            await bot.send_message(message.chat.id, f"📘 <b>{book[1]}</b>\n✍️ {book[2]}", parse_mode="HTML", reply_markup=kb)
 
 # --- ADMIN COMMANDS ---
 @bot.message_handler(commands=['clear_library'])
-def clear_library_command(message):
+async def clear_library_command(message):
     if message.from_user.id != ADMIN_ID:
         return
-    asyncio.run(db.clear_library())
-    bot.reply_to(message, "🗑 <b>Kutubxona tozalandi!</b>\nBarcha PDF fayllar bazadan o'chirildi.", parse_mode="HTML")
+    await db.clear_library()
+    await bot.reply_to(message, "🗑 <b>Kutubxona tozalandi!</b>\nBarcha PDF fayllar bazadan o'chirildi.", parse_mode="HTML")
+
+@bot.message_handler(commands=['db_stats'])
+async def db_stats_command(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    s = db.pool.stats()
+    w = db.writes.stats()
+    txt = (
+        f"🗄 <b>DB pool</b>\n\n"
+        f"Readers: {s['size']} (bo'sh: {s['idle']}, eng ko'p band: {s['peak_in_use']})\n"
+        f"Olishlar: {s['acquired']} | kutganlar: {s['waited']} ({s['saturation']:.1%})\n"
+        f"Kutish: o'rtacha {s['wait_avg_ms']:.2f} ms, max {s['wait_max'] * 1000:.2f} ms\n"
+        f"Yozishlar: {s['writes']} | kutganlar: {s['write_waited']}, o'rtacha {s['write_wait_avg_ms']:.2f} ms\n"
+        f"Navbat ({w['durability']}): {w['jobs']} yozuv, {w['batches']} commit (o'rtacha {w['batch_avg']:.1f}, max {w['batch_max']}), "
+        f"kutmoqda: {w['pending']}, xato: {w['failed']}, commit {w['commit_avg_ms']:.2f} ms\n\n"
+    )
+    avg_ms = limiter.total_time / limiter.handled * 1000 if limiter.handled else 0.0
+    txt += (
+        f"⚡️ <b>Yangilanishlar</b>\n"
+        f"Bajarildi: {limiter.handled} | hozir: {limiter.active}/{limiter.limit}, eng ko'p: {limiter.peak}\n"
+        f"Vaqt: o'rtacha {avg_ms:.1f} ms, max {limiter.max_time * 1000:.1f} ms"
+    )
+    await bot.reply_to(message, txt, parse_mode="HTML")
+
+# --- SEARCH ---
+@bot.message_handler(commands=['search', 'qidir'])
+async def search_command(message):
+    parts = message.text.split(maxsplit=1)
+    query = parts[1] if len(parts) > 1 else ""
+    if not query.strip():
+        await bot.reply_to(message, "🔍 Kitob yoki muallif nomini yozing:\n<code>/qidir O'tkan kunlar</code>", parse_mode="HTML")
+        return
+    
+    results = await db.search_books(query)
+    # Exact hits first, then typo / other-script matches (books and PDFs)
+    found = {b_id for b_id, *_ in results}
+    similar = [m for m in await db.fuzzy_search(query) if not (m[0] == "book" and m[1] in found)]
+    similar = similar[:10 - len(results)]
+    if not results and not similar:
+        await bot.reply_to(message, "😕 Hech narsa topilmadi.")
+        return
+    
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    txt = "🔍 <b>Qidiruv natijalari:</b>\n\n"
+    for b_id, title, author, _ in results:
+        txt += f"📘 {title} — <i>{author}</i>\n"
+        display_title = title if len(title) < 35 else title[:33] + "..."
+        kb.add(types.InlineKeyboardButton(f"📘 {display_title}", callback_data=f"startquiz_{b_id}"))
+    
+    if similar:
+        txt += ("\n" if results else "") + "🤔 <b>Balki shularni nazarda tutgandirsiz:</b>\n"
+    for kind, item_id, title in similar:
+        display_title = title if len(title) < 35 else title[:33] + "..."
+        if kind == "book":
+            txt += f"📘 {title}\n"
+            kb.add(types.InlineKeyboardButton(f"📘 {display_title}", callback_data=f"startquiz_{item_id}"))
+        else:
+            txt += f"📥 {title}\n"
+            kb.add(types.InlineKeyboardButton(f"📥 {display_title}", callback_data=f"getpdf_{item_id}"))
+    
+    await bot.reply_to(message, txt, parse_mode="HTML", reply_markup=kb)
+
+# --- INLINE MODE ---
+# Answers come from the in-memory prefix index; result objects are built
+# once per row (a row carries everything they show, so it is its own key).
+inline_results = RenderCache(max_entries=4096)
+
+def inline_result(row):
+    result = inline_results.get(row)
+    if result is not None:
+        return result
+    if row[0] == "book":
+        _, b_id, title, author, desc = row
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("🧠 Testni boshlash", url=f"https://t.me/{BOT_NAME.lstrip('@')}?start=book_{b_id}"))
+        result = types.InlineQueryResultArticle(
+            id=f"book_{b_id}",
+            title=title,
+            description=author,
+            input_message_content=types.InputTextMessageContent(f"📘 <b>{title}</b>\n✍️ {author}\n\n{desc}", parse_mode="HTML"),
+            reply_markup=kb
+        )
+    else:
+        _, p_id, title, file_id = row
+        result = types.InlineQueryResultCachedDocument(id=f"pdf_{p_id}", document_file_id=file_id, title=title, caption=f"📥 {title}")
+    inline_results.put(row, result)
+    return result
+
+@bot.inline_handler(func=lambda query: True)
+async def inline_search(query):
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    rows, next_offset = await db.inline_search(query.query, offset, INLINE_PAGE)
+    await bot.answer_inline_query(
+        query.id,
+        [inline_result(row) for row in rows],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(next_offset) if next_offset is not None else ""
+    )
+
+# --- CLANS ---
+CLAN_NAME = re.compile(r"[\w' -]{2,32}")
+
+@bot.message_handler(commands=['klan', 'clan'])
+async def clan_command(message):
+    parts = message.text.split(maxsplit=1)
+    name = " ".join(parts[1].split()) if len(parts) > 1 else ""
+    
+    if not name:
+        stats = await db.get_user_stats(message.from_user.id)
+        clan = await db.get_clan(stats[5]) if stats and stats[5] else None
+        if clan:
+            txt = (
+                f"🛡 <b>Klan:</b> {clan[0]}\n"
+                f"👥 A'zolar: {clan[1]}\n"
+                f"⭐️ Ballar: {clan[2]}\n"
+                f"📚 O'qilgan kitoblar: {clan[3]}\n\n"
+                f"Chiqish: /klandan_chiqish"
+            )
+        else:
+            txt = "🛡 Siz hali klanda emassiz.\nQo'shilish yoki yangi klan tuzish: <code>/klan Nomi</code>"
+        await bot.reply_to(message, txt, parse_mode="HTML")
+        return
+    
+    if not CLAN_NAME.fullmatch(name):
+        await bot.reply_to(message, "⚠️ Klan nomi 2–32 ta harf, raqam yoki bo'shliqdan iborat bo'lsin.")
+        return
+    
+    await db.add_user(message.from_user.id, message.from_user.full_name)
+    clan = await db.join_clan(message.from_user.id, name)
+    await bot.reply_to(message, f"✅ Siz <b>{clan}</b> klaniga qo'shildingiz!\nReyting: /klanlar", parse_mode="HTML")
+
+@bot.message_handler(commands=['klandan_chiqish', 'leave_clan'])
+async def leave_clan_command(message):
+    clan = await db.leave_clan(message.from_user.id)
+    if clan:
+        await bot.reply_to(message, f"👋 Siz <b>{clan}</b> klanidan chiqdingiz.", parse_mode="HTML")
+    else:
+        await bot.reply_to(message, "Siz hech qaysi klanda emassiz.")
+
+@bot.message_handler(commands=['klanlar', 'clans'])
+async def clans_command(message):
+    txt = await leaderboard_text("clans")
+    await bot.reply_to(message, txt, parse_mode="HTML", reply_markup=leaderboard_kb("clans"))
 
 # --- DOCUMENT UPLOAD ---
 @bot.message_handler(content_types=['document'])
-def handle_document_upload(message):
+async def handle_document_upload(message):
     if message.from_user.id != ADMIN_ID:
         return
     
@@ -157,13 +413,13 @@ def handle_document_upload(message):
         file_name = doc.file_name
         clean_name = file_name.replace('.pdf', '').replace('_', ' ')
         
-        asyncio.run(db.add_pdf(clean_name, file_id))
-        bot.reply_to(message, f"✅ <b>Kitob bazaga qo'shildi!</b>\n\nNomi: {clean_name}", parse_mode="HTML")
+        await db.add_pdf(clean_name, file_id)
+        await bot.reply_to(message, f"✅ <b>Kitob bazaga qo'shildi!</b>\n\nNomi: {clean_name}", parse_mode="HTML")
     
     elif doc.mime_type == 'application/json':
         try:
-            file_info = bot.get_file(doc.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
+            file_info = await bot.get_file(doc.file_id)
+            downloaded_file = await bot.download_file(file_info.file_path)
             content = downloaded_file.decode('utf-8')
             data = json.loads(content)
             
@@ -174,31 +430,30 @@ def handle_document_upload(message):
             category = data.get('category', 'Badiiy')
             
             if title and author and questions:
-                asyncio.run(db.add_book_with_quiz(title, author, desc, json.dumps(questions, ensure_ascii=False), category))
-                bot.reply_to(message, f"✅ <b>\"{title}\"</b> muvaffaqiyatli qo'shildi!", parse_mode="HTML")
+                await db.add_book_with_quiz(title, author, desc, json.dumps(questions, ensure_ascii=False), category)
+                await bot.reply_to(message, f"✅ <b>\"{title}\"</b> muvaffaqiyatli qo'shildi!", parse_mode="HTML")
             else:
-                bot.reply_to(message, "❌ JSON fayl tuzilishi noto'g'ri!")
+                await bot.reply_to(message, "❌ JSON fayl tuzilishi noto'g'ri!")
         except Exception as e:
-            bot.reply_to(message, f"❌ Xatolik yuz berdi: {e}")
+            await bot.reply_to(message, f"❌ Xatolik yuz berdi: {e}")
     else:
-        bot.reply_to(message, "⚠️ Iltimos, faqat PDF yoki JSON (test) fayl yuklang.")
+        await bot.reply_to(message, "⚠️ Iltimos, faqat PDF yoki JSON (test) fayl yuklang.")
 
 # --- MAIN MENU NAVIGATION ---
 
-@bot.message_handler(func=lambda m: m.text == "🏛 Ziyo Maskani (Test)")
-def ziyo_maskani(message):
-    books = asyncio.run(db.get_all_books())
-    if not books:
-        bot.reply_to(message, "Hozircha testlar yo'q.")
+@router.text("🏛 Ziyo Maskani (Test)")
+async def ziyo_maskani(message):
+    kb = await test_page_payload(1)
+    if kb is None:
+        await bot.reply_to(message, "Hozircha testlar yo'q.")
         return
     
-    kb = get_test_page_markup(books, 1)
-    bot.send_message(message.chat.id, "📚 <b>Qaysi asar bo'yicha bilimingizni sinamoqchisiz?</b>", parse_mode="HTML", reply_markup=kb)
+    await bot.send_message(message.chat.id, CATALOG_PROMPT, parse_mode="HTML", reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.text == "✍️ Kitob Qo'shish")
-def add_book_guide(message):
+@router.text("✍️ Kitob Qo'shish")
+async def add_book_guide(message):
     if message.from_user.id == ADMIN_ID:
-        bot.reply_to(
+        await bot.reply_to(
             message,
             "👨‍💻 <b>Admin panel:</b>\n\n"
             "1. <b>Test yuklash:</b> .json fayl yuboring.\n"
@@ -207,25 +462,46 @@ def add_book_guide(message):
             parse_mode="HTML"
         )
     else:
-        bot.reply_to(message, "Bu bo'lim faqat adminlar uchun!")
+        await bot.reply_to(message, "Bu bo'lim faqat adminlar uchun!")
 
-@bot.message_handler(func=lambda m: m.text == "📥 Elektron Kutubxona")
-def ebook_library(message):
-    pdfs = asyncio.run(db.get_all_pdfs())
-    if not pdfs:
-        bot.reply_to(message, "📭 Kutubxona hozircha bo'sh.")
+@router.text("📥 Elektron Kutubxona")
+async def ebook_library(message):
+    kb = await library_page_payload(1)
+    if kb is None:
+        await bot.reply_to(message, "📭 Kutubxona hozircha bo'sh.")
         return
     
-    kb = get_library_page_markup(pdfs, 1)
-    bot.send_message(message.chat.id, "📚 <b>Elektron Kutubxona:</b>\nMarhamat, o'qish uchun kitob tanlang:", parse_mode="HTML", reply_markup=kb)
+    await bot.send_message(message.chat.id, LIBRARY_PROMPT, parse_mode="HTML", reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.text == "🏆 Peshiqadamlar")
-def leaderboard(message):
-    leaders = asyncio.run(db.get_leaderboard())
-    
+LEADERBOARD_TITLES = {
+    "all": "🏆 <b>Eng faol kitobxonlar</b>",
+    "week": "🏆 <b>Haftaning eng faol kitobxonlari</b>",
+    "month": "🏆 <b>Oyning eng faol kitobxonlari</b>",
+    "clans": "🛡 <b>Eng kuchli klanlar</b>",
+}
+
+def leaderboard_kb(period):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    labels = [("week", "📅 Hafta"), ("month", "🗓 Oy"), ("all", "♾ Umumiy"), ("clans", "🛡 Klanlar")]
+    kb.add(*[types.InlineKeyboardButton(f"• {label} •" if key == period else label, callback_data=f"top_{key}")
+             for key, label in labels])
+    return kb
+
+async def leaderboard_text(period):
     medals = ["🥇", "🥈", "🥉"]
-    txt = "🏆 <b>Eng faol kitobxonlar</b>\n\n"
-    
+    txt = f"{LEADERBOARD_TITLES[period]}\n\n"
+    
+    if period == "clans":
+        clans = await db.get_clan_leaderboard()
+        for idx, (name, members, points, books_read) in enumerate(clans):
+            rank = medals[idx] if idx < 3 else f"<b>{idx+1}.</b>"
+            txt += f"{rank} {name}\n"
+            txt += f"   └ ⭐️ {points} | 👥 {members} | 📚 {books_read}\n"
+        if not clans:
+            txt += "Hozircha klanlar yo'q.\n<code>/klan Nomi</code> bilan birinchisini tuzing!"
+        return txt
+    
+    leaders = await db.get_leaderboard(period)
     for idx, user in enumerate(leaders):
         name, score, streak, books_read = user
         rank = medals[idx] if idx < 3 else f"<b>{idx+1}.</b>"
@@ -235,229 +511,373 @@ def leaderboard(message):
         if idx == 2:
             txt += "➖➖➖➖➖➖➖➖➖➖\n"
     
-    bot.reply_to(message, txt, parse_mode="HTML")
+    if not leaders:
+        txt += "Hozircha hech kim ball to'plamadi."
+    return txt
+
+@router.text("🏆 Peshiqadamlar")
+async def leaderboard(message):
+    txt = await leaderboard_text("all")
+    await bot.reply_to(message, txt, parse_mode="HTML", reply_markup=leaderboard_kb("all"))
 
-@bot.message_handler(func=lambda m: m.text == "👤 Mening Profilim")
-def my_profile(message):
-    stats = asyncio.run(db.get_user_stats(message.from_user.id))
+@router.text("👤 Mening Profilim")
+async def my_profile(message):
+    stats = await db.get_user_stats(message.from_user.id)
     if not stats:
-        bot.reply_to(message, "Ma'lumot topilmadi.")
+        await bot.reply_to(message, "Ma'lumot topilmadi.")
         return
     
     user_id, fullname, points, streak, _, _ = stats
+    rank, total, ahead, _ = await db.get_rank(user_id) or (None, None, None, None)
+    rank_text = f"#{rank} / {total}" if rank else "—"
+    # Progress toward the nearest user ahead; full when already first
+    progress = points / ahead[1] if ahead else 1.0
     
     # Fetch User Avatar
     avatar_bytes = None
     try:
-        photos = bot.get_user_profile_photos(user_id, limit=1)
+        photos = await bot.get_user_profile_photos(user_id, limit=1)
         if photos.total_count > 0:
             file_id = photos.photos[0][-1].file_id
-            file_info = bot.get_file(file_id)
-            avatar_bytes = bot.download_file(file_info.file_path)
+            file_info = await bot.get_file(file_id)
+            avatar_bytes = await bot.download_file(file_info.file_path)
     except Exception as e:
         print(f"Profile photo error: {e}")
     
     # Generate Image
-    img_io = generate_profile_card(fullname, "Kitobxon", points, streak, avatar_bytes)
+    img_io = await asyncio.to_thread(generate_profile_card, fullname, rank_text, points, progress, avatar_bytes)
     
     caption = (
         f"👤 <b>Foydalanuvchi:</b> {fullname}\n"
+        f"🏅 <b>O'rin:</b> {rank_text}\n"
         f"⭐️ <b>Ballar:</b> {points}\n"
         f"🔥 <b>Davomiylik:</b> {streak} kun"
     )
-    
-    bot.send_photo(message.chat.id, img_io, caption=caption, parse_mode="HTML")
-
-@bot.message_handler(func=lambda m: m.text == "🎲 Tasodifiy Kitob")
-def random_book(message):
-    recommendation = asyncio.run(db.get_recommendations(message.from_user.id))
-    bot.reply_to(message, recommendation, parse_mode="HTML")
-
-@bot.message_handler(func=lambda m: m.text == "📚 O'qilgan Kitoblar")
-def my_read_books(message):
-    books = asyncio.run(db.get_user_books_list(message.from_user.id))
+    if ahead:
+        caption += f"\n⬆️ <b>Keyingi o'rin:</b> {ahead[0]} — yana {ahead[1] - points} ball"
+    
+    await bot.send_photo(message.chat.id, img_io, caption=caption, parse_mode="HTML")
+
+@router.text("🎲 Tasodifiy Kitob")
+async def random_book(message):
+    recommendation = await db.get_recommendations(message.from_user.id)
+    if recommendation is None and len(recommendation_bag):
+        seed, cursor = await db.next_in_bag(message.from_user.id, len(recommendation_bag))
+        recommendation = f"🎲 <b>Tasodifiy tavsiya:</b>\n\n{recommendation_bag.pick(seed, cursor)}"
+    if recommendation is None:
+        recommendation = "📭 Hozircha barcha kitoblarni o'qib bo'ldingiz!"
+    await bot.reply_to(message, recommendation, parse_mode="HTML")
+
+@router.text("📚 O'qilgan Kitoblar")
+async def my_read_books(message):
+    books = await db.get_user_books_list(message.from_user.id)
     if not books:
-        bot.reply_to(message, "Siz hali hech qanday kitob o'qimadingiz.")
+        await bot.reply_to(message, "Siz hali hech qanday kitob o'qimadingiz.")
         return
     
     txt = "📚 <b>Siz o'qigan kitoblar:</b>\n\n"
     for b_name, date in books:
         txt += f"✅ {b_name} ({date})\n"
     
-    bot.reply_to(message, txt, parse_mode="HTML")
+    await bot.reply_to(message, txt, parse_mode="HTML")
 
 # --- QUIZ CALLBACKS ---
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("startquiz_"))
-def start_quiz_callback(call):
-    book_id = int(call.data.split("_")[1])
-    book = asyncio.run(db.get_book_details(book_id))
+def render_question(number, question):
+    """Build (text, keyboard JSON) for one quiz step."""
+    _, q_text, opts, correct_idx = question
+    # Shuffle option positions; the correct one is known by index
+    order = list(range(len(opts)))
+    random.shuffle(order)
     
-    if not book:
-        bot.answer_callback_query(call.id, "Kitob topilmadi!", show_alert=True)
-        return
+    labels = ["A", "B", "C"]
+    display_opts = order[:3]
     
-    questions = json.loads(book[4])
-    random.shuffle(questions)
+    txt = f"❓ <b>{number}-savol:</b>\n\n{q_text}\n\n"
+    for i, opt_idx in enumerate(display_opts):
+        txt += f"<b>{labels[i]})</b> {opts[opt_idx]}\n"
     
-    quiz_session[call.from_user.id] = {
-        'book_id': book_id,
-        'book_title': book[1],
-        'score': 0,
-        'q_idx': 0,
-        'questions': questions
-    }
+    kb = types.InlineKeyboardMarkup(row_width=3)
+    row_btns = []
+    for i, opt_idx in enumerate(display_opts):
+        is_correct = "1" if opt_idx == correct_idx else "0"
+        row_btns.append(types.InlineKeyboardButton(f"[ {labels[i]} ]", callback_data=f"ans_{is_correct}"))
     
-    bot.delete_message(call.message.chat.id, call.message.message_id)
-    send_quiz_question(call.message.chat.id, call.from_user.id)
+    kb.add(*row_btns)
+    return txt, kb.to_json()
+
+async def quiz_step(user_id, session):
+    # Every step is rendered once when the quiz starts (or after a restart);
+    # the entry remembers its question ids so another quiz never reuses it
+    question_ids = tuple(session.question_ids)
+    cached = rendered_quizzes.get(user_id)
+    if cached is not None and cached[0] == question_ids:
+        steps = cached[1]
+    else:
+        questions = await db.get_questions(question_ids)
+        steps = [render_question(i + 1, q) for i, q in enumerate(questions)]
+        rendered_quizzes.put(user_id, (question_ids, steps))
+    if session.q_idx < len(steps):
+        return steps[session.q_idx]
+    return None
+
+async def present(call, text, reply_markup=None, callback_text=None):
+    """Show the next quiz screen in place of the tapped message."""
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    if QUIZ_EDIT_IN_PLACE:
+        # One edit instead of delete + send, overlapped with the callback answer
+        await asyncio.gather(
+            bot.answer_callback_query(call.id, callback_text),
+            bot.edit_message_text(text, chat_id, message_id, parse_mode="HTML", reply_markup=reply_markup),
+        )
+    else:
+        await bot.answer_callback_query(call.id, callback_text)
+        await bot.delete_message(chat_id, message_id)
+        await bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=reply_markup)
 
-def send_quiz_question(chat_id, user_id):
-    session = quiz_session.get(user_id)
-    if not session:
-        return
-    
-    q_idx = session['q_idx']
-    questions = session['questions']
+@router.callback("startquiz_", parse_int)
+async def start_quiz_callback(call, book_id):
+    book = await db.get_book(book_id)
     
-    if q_idx >= len(questions) or q_idx >= 10:
-        finish_quiz(chat_id, user_id)
+    if not book:
+        await bot.answer_callback_query(call.id, "Kitob topilmadi!", show_alert=True)
         return
     
-    q_data = questions[q_idx]
-    opts = q_data['opts'].copy()
-    random.shuffle(opts)
-    
-    correct_opt = q_data['ans']
-    correct_idx = -1
-    for i, o in enumerate(opts):
-        if o == correct_opt:
-            correct_idx = i
-            break
-    
-    labels = ["A", "B", "C"]
-    display_opts = opts[:3]
-    
-    txt = f"❓ <b>{q_idx+1}-savol:</b>\n\n{q_data['q']}\n\n"
-    for i, opt in enumerate(display_opts):
-        txt += f"<b>{labels[i]})</b> {opt}\n"
+    # Up to 10 questions, sampled in SQLite
+    question_ids = await db.sample_question_ids(book_id, QUIZ_LENGTH)
+    if not question_ids:
+        await bot.answer_callback_query(call.id, "Bu kitob uchun savollar yo'q.", show_alert=True)
+        return
     
-    kb = types.InlineKeyboardMarkup(row_width=3)
-    row_btns = []
-    for i in range(len(display_opts)):
-        is_correct = "1" if i == correct_idx else "0"
-        row_btns.append(types.InlineKeyboardButton(f"[ {labels[i]} ]", callback_data=f"ans_{is_correct}"))
+    rendered_quizzes.pop(call.from_user.id)
+    session = sessions.start(call.from_user.id, book_id, book[1], question_ids)
+    await send_quiz_question(call, session)
+
+async def send_quiz_question(call, session, callback_text=None):
+    step = await quiz_step(call.from_user.id, session)
+    if step is None:
+        await finish_quiz(call, session, callback_text)
+        return
     
-    kb.add(*row_btns)
-    bot.send_message(chat_id, txt, parse_mode="HTML", reply_markup=kb)
+    txt, kb = step
+    await present(call, txt, kb, callback_text)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("ans_"))
-def answer_callback(call):
-    is_correct = call.data.split("_")[1] == "1"
-    session = quiz_session.get(call.from_user.id)
+@router.callback("ans_", parse_flag)
+async def answer_callback(call, is_correct):
+    session = sessions.get(call.from_user.id)
     
     if not session:
-        bot.answer_callback_query(call.id, "Sessiya tugagan.", show_alert=True)
+        rendered_quizzes.pop(call.from_user.id)
+        await bot.answer_callback_query(call.id, "Sessiya tugagan.", show_alert=True)
         return
     
     if is_correct:
-        session['score'] += 1
-        bot.answer_callback_query(call.id, "✅ To'g'ri!")
-    else:
-        bot.answer_callback_query(call.id, "❌ Xato!")
+        session.score += 1
     
-    session['q_idx'] += 1
-    bot.delete_message(call.message.chat.id, call.message.message_id)
-    send_quiz_question(call.message.chat.id, call.from_user.id)
+    question_id = session.current_question()
+    session.q_idx += 1
+    if question_id is not None:
+        db.record_answer(question_id, is_correct)
+    await send_quiz_question(call, session, "✅ To'g'ri!" if is_correct else "❌ Xato!")
 
-def finish_quiz(chat_id, user_id):
-    session = quiz_session.get(user_id)
-    if not session:
-        return
+async def finish_quiz(call, session, callback_text=None):
+    user_id = call.from_user.id
+    sessions.finish(user_id)
+    rendered_quizzes.pop(user_id)
     
-    score = session['score']
-    total = min(len(session['questions']), 10)
+    score = session.score
+    total = session.total
     
-    asyncio.run(db.update_points(user_id, score * 10))
+    await db.update_points(user_id, score * 10)
     if score >= total / 2:
-        asyncio.run(db.add_read_book(user_id, session['book_title']))
+        await db.add_read_book(user_id, session.book_title, session.book_id)
     
     msg = f"🏁 <b>Test yakunlandi!</b>\n\n✅ Natija: {score}/{total}\n⭐️ Ballar: +{score * 10}"
-    quiz_session[user_id] = None
-    bot.send_message(chat_id, msg, parse_mode="HTML", reply_markup=main_menu())
+    # The reply keyboard from /start stays under the chat, so an edit is enough;
+    # the inline keyboard offers the closest books by content
+    kb = None
+    similar = await db.get_similar_books(session.book_id)
+    if similar:
+        msg += "\n\n📚 <b>O'xshash kitoblar:</b>"
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        for b_id, title, _ in similar:
+            display_title = title if len(title) < 35 else title[:33] + "..."
+            kb.add(types.InlineKeyboardButton(f"📘 {display_title}", callback_data=f"startquiz_{b_id}"))
+    await present(call, msg, kb, callback_text)
 
 # --- PDF DOWNLOAD ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("getpdf_"))
-def get_pdf_callback(call):
-    file_id_record = asyncio.run(db.get_pdf_by_id(int(call.data.split("_")[1])))
+@router.callback("getpdf_", parse_int)
+async def get_pdf_callback(call, pdf_id):
+    file_id_record = await db.get_pdf_by_id(pdf_id)
     
     if file_id_record:
         file_id, title = file_id_record
-        bot.send_document(call.message.chat.id, file_id, caption=f"📕 <b>{title}</b>", parse_mode="HTML")
-        bot.answer_callback_query(call.id)
+        await bot.send_document(call.message.chat.id, file_id, caption=f"📕 <b>{title}</b>", parse_mode="HTML")
+        await bot.answer_callback_query(call.id)
     else:
-        bot.answer_callback_query(call.id, "❌ Fayl topilmadi.", show_alert=True)
+        await bot.answer_callback_query(call.id, "❌ Fayl topilmadi.", show_alert=True)
 
 # --- PAGINATION HANDLERS ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("test_"))
-def test_pagination(call):
-    action, page = call.data.split("_")[1], int(call.data.split("_")[2])
-    new_page = page - 1 if action == "prev" else page + 1
+@router.callback("test_", parse_page)
+async def test_pagination(call, nav):
+    new_page = nav.page - 1 if nav.action == "prev" else nav.page + 1
     
-    books = asyncio.run(db.get_all_books())
-    kb = get_test_page_markup(books, new_page)
+    kb = await test_page_payload(new_page)
+    if kb is None:
+        await bot.answer_callback_query(call.id, "Hozircha testlar yo'q.")
+        return
     
-    bot.edit_message_text(
-        "📚 <b>Qaysi asar bo'yicha bilimingizni sinamoqchisiz?</b>",
+    await bot.edit_message_text(
+        CATALOG_PROMPT,
         call.message.chat.id,
         call.message.message_id,
         parse_mode="HTML",
         reply_markup=kb
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("lib_"))
-def lib_pagination(call):
-    action, page = call.data.split("_")[1], int(call.data.split("_")[2])
-    new_page = page - 1 if action == "prev" else page + 1
+@router.callback("lib_", parse_page)
+async def lib_pagination(call, nav):
+    new_page = nav.page - 1 if nav.action == "prev" else nav.page + 1
     
-    pdfs = asyncio.run(db.get_all_pdfs())
-    kb = get_library_page_markup(pdfs, new_page)
+    if nav.action == "next":
+        kb = await library_page_payload(new_page, after=nav.cursor)
+    else:
+        kb = await library_page_payload(new_page, before=nav.cursor)
+    if kb is None:
+        # Library changed under the keyboard; start over from the first page
+        kb = await library_page_payload(1)
+    if kb is None:
+        await bot.answer_callback_query(call.id, "📭 Kutubxona hozircha bo'sh.")
+        return
     
-    bot.edit_message_text(
-        "� <b>Elektron Kutubxona:</b>\nMarhamat, o'qish uchun kitob tanlang:",
+    await bot.edit_message_text(
+        LIBRARY_PROMPT,
         call.message.chat.id,
         call.message.message_id,
         parse_mode="HTML",
         reply_markup=kb
     )
 
-@bot.callback_query_handler(func=lambda call: call.data == "noop")
-def noop_callback(call):
-    bot.answer_callback_query(call.id)
+@router.callback("top_", parse_choice("all", "week", "month", "clans"))
+async def leaderboard_callback(call, period):
+    txt = await leaderboard_text(period)
+    try:
+        await bot.edit_message_text(txt, call.message.chat.id, call.message.message_id, parse_mode="HTML", reply_markup=leaderboard_kb(period))
+    except Exception:
+        pass  # same board tapped again: "message is not modified"
+    await bot.answer_callback_query(call.id)
+
+@router.callback("noop")
+async def noop_callback(call, _):
+    await bot.answer_callback_query(call.id)
+
+# --- ROUTING ---
+# Registered last so /commands and document uploads are matched first
+
+@bot.message_handler(content_types=['text'])
+async def route_message(message):
+    handler = router.match_text(message.text)
+    if handler:
+        await handler(message)
+
+@bot.callback_query_handler(func=lambda call: True)
+async def route_callback(call):
+    try:
+        route = router.match_callback(call.data)
+    except ValueError:
+        route = None  # malformed payload, e.g. from an old keyboard
+    if route is None:
+        await bot.answer_callback_query(call.id)
+        return
+    handler, payload = route
+    await handler(call, payload)
 
 # ==========================================
 # 4. MAIN EXECUTION
 # ==========================================
 
-def main():
-    # Force migrate data on startup
-    asyncio.run(db.create_tables())
-    asyncio.run(db.force_migrate(LIBRARY_DATA))
+checkpoint_lock = asyncio.Lock()
+
+async def checkpoint_sessions():
+    # One at a time, so the final checkpoint on shutdown waits for a periodic one
+    async with checkpoint_lock:
+        sessions.evict_expired()
+        rows, finished = sessions.take_changes()
+        await db.save_quiz_sessions(rows, finished)
+
+async def session_checkpoint_loop():
+    while True:
+        await asyncio.sleep(SESSION_CHECKPOINT)
+        try:
+            # Shielded: stopping the loop mid-save must not drop changes already taken
+            await asyncio.shield(checkpoint_sessions())
+        except Exception as e:
+            logging.error(f"Session checkpoint error: {e}")
+
+async def maintenance_loop():
+    while True:
+        try:
+            await db.compact_ledger(LEDGER_KEEP_DAYS)
+            await db.rebuild_coreads()
+        except Exception as e:
+            logging.error(f"Maintenance error: {e}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+async def main():
+    # Sync catalog with LIBRARY_DATA on startup (only changed books are written)
+    await db.create_tables()
+    await db.sync_catalog(LIBRARY_DATA)
+    await db.search_indexes()
+    await db.rank_index()
+    await db.similar_index()
+    await db.content_index()
+    await db.load_known_users()
+    restored = sessions.restore(await db.load_quiz_sessions())
+    print(f"♻️ {restored} ta test sessiyasi tiklandi")
+    checkpointer = asyncio.create_task(session_checkpoint_loop())
+    maintenance = asyncio.create_task(maintenance_loop())
     
     # Aggressively clear webhooks and wait
     try:
-        bot.remove_webhook()
-        import time
-        time.sleep(1)
+        await bot.remove_webhook()
+        await asyncio.sleep(1)
         print("✅ Webhook tozalandi")
     except Exception as e:
         print(f"⚠️ Webhook xatosi: {e}")
     
+    # SIGTERM (docker stop, restart) and SIGINT end polling the same way, so
+    # the shutdown below always runs
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except NotImplementedError:  # Windows: Ctrl+C still cancels main()
+            pass
+    
     print("🚀 Bot ishga tushdi...")
-    bot.infinity_polling(timeout=10, long_polling_timeout=5)
+    polling = asyncio.create_task(bot.infinity_polling(timeout=5, request_timeout=10))
+    stopper = asyncio.create_task(stopping.wait())
+    try:
+        await asyncio.wait({polling, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        print("🛑 Bot to'xtatilmoqda...")
+        stopper.cancel()
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        # Updates already taken from Telegram finish before their writes are flushed
+        try:
+            await asyncio.wait_for(limiter.drain(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Shutdown: %s updates still running after %ss", limiter.active, SHUTDOWN_TIMEOUT)
+        checkpointer.cancel()
+        maintenance.cancel()
+        await checkpoint_sessions()
+        await db.close()
 
 if __name__ == '__main__':
     try:
-        main()
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("\n🛑 Bot to'xtatildi")
     except Exception as e:
@@ -0,0 +1,47 @@
+class CatalogCache:
+    """In-process copy of the books catalog (everything except quiz questions).
+
+    The catalog only changes on admin upload or the startup sync, so the
+    DatabaseManager loads it once and drops it on those writes. `version`
+    moves on every invalidation; anything derived from the catalog can use
+    it as a cache key.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.books = None  # [(id, title, author, desc, category, question_count), ...] ordered by id
+        self.by_id = {}
+
+    @property
+    def loaded(self):
+        return self.books is not None
+
+    def load(self, rows, version):
+        # A write that landed while rows were being read makes them stale
+        if version != self.version:
+            return False
+        self.books = list(rows)
+        self.by_id = {row[0]: row for row in self.books}
+        return True
+
+    def invalidate(self):
+        self.version += 1
+        self.books = None
+        self.by_id = {}
+
+    def count(self):
+        return len(self.books)
+
+    def get(self, book_id):
+        return self.by_id.get(book_id)
+
+    def listing(self):
+        return [row[:3] for row in self.books]
+
+    def page(self, page, per_page):
+        """Return (rows, total_pages) for a 1-based page of (id, title, author)."""
+        total_pages = max(1, (len(self.books) + per_page - 1) // per_page)
+        page = min(max(page, 1), total_pages)
+        start = (page - 1) * per_page
+        rows = [row[:3] for row in self.books[start:start + per_page]]
+        return rows, total_pages
@@ -1114,7 +1114,7 @@ RECOMMENDATIONS = [
     "📗 <b>«Alvido, Buxoro» — tarixiy asar</b>\nVatan va sog'inch.",
     "📘 <b>«Yonayotgan Buxoro» — tarixiy roman</b>\nZulm ostidagi xalq hayoti.",
     "📙 <b>«1924: Turkistonning parchalanishi» — tarixiy tadqiqot</b>\nSun'iy chegaralar fojeasi.",
-    "📓 <b>«Biz kimmiz?» — Xojiakbar Ibrohim</b>\nMilliy o'zlik haqida."
+    "📓 <b>«Biz kimmiz?» — Xojiakbar Ibrohim</b>\nMilliy o'zlik haqida.",
     "📕 <b>«O‘smir» — Fyodor Dostoyevskiy</b>\nYosh insonning ruhiy izlanishlari.",
     "📗 <b>«Telba» — Jaloliddin Rumiy</b>\nIshq va ma’naviy uyg‘onish.",
     "📘 <b>«Masnaviy» — Jaloliddin Rumiy</b>\nTasavvuf va hikmatlar xazinasi.",
@@ -1152,10 +1152,9 @@ RECOMMENDATIONS = [
     "📓 <b>«Iymon va amal» — diniy risola</b>\nAmal va e’tiqod uyg‘unligi.",
 
     "📕 <b>«Yolg‘izlikning yuz yili» — Gabriel Garsia Markes</b>\nAvlodlar va taqdir hikoyasi.",
-    "📗 <b>«Chol va dengiz» — Ernest Xeminguey</b>\nMatonat va mag‘lubiyat.",
     "📘 <b>«Sharqdan xatlar» — Hermann Hesse</b>\nIchki izlanishlar.",
     "📙 <b>«Siddhartha» — Hermann Hesse</b>\nMa’naviy kamolot yo‘li.",
-    "📓 <b>«Hayot senga nimani o‘rgatdi?» — motivatsion asar</b>\nO‘zini anglash yo‘li."
+    "📓 <b>«Hayot senga nimani o‘rgatdi?» — motivatsion asar</b>\nO‘zini anglash yo‘li.",
     "📕 <b>«Ufq» — Chingiz Aytmatov</b>\nInson va zamon o‘rtasidagi murakkab munosabat.",
     "📗 <b>«Asrga tatigulik kun» — Chingiz Aytmatov</b>\nXotira, tarix va kelajak haqida roman.",
     "📘 <b>«Jamila» — Chingiz Aytmatov</b>\nSodda, ammo chuqur muhabbat qissasi.",
@@ -1202,7 +1201,7 @@ RECOMMENDATIONS = [
     "📗 <b>«Inson va jamiyat» — ijtimoiy tahlil</b>\nJamiyatdagi mas’uliyat.",
     "📘 <b>«Vijdon sadosi» — badiiy asar</b>\nTo‘g‘ri va noto‘g‘ri tanlovlar.",
     "📙 <b>«Or-nomus» — ijtimoiy roman</b>\nSha’n va qadriyatlar.",
-    "📓 <b>«So‘nggi imkon» — dramatik asar</b>\nHayotiy burilishlar."
+    "📓 <b>«So‘nggi imkon» — dramatik asar</b>\nHayotiy burilishlar.",
     "📕 <b>«Qiyomat» — Chingiz Aytmatov</b>\nInsoniyat va axloqiy tanazzul haqida og‘ir roman.",
     "📗 <b>«Ona zamin» — Chingiz Aytmatov</b>\nUrush va ona qalbi fojiasi.",
     "📘 <b>«Erta kelgan turnalar» — Chingiz Aytmatov</b>\nSog‘inch va yo‘qotish.",
@@ -1249,8 +1248,8 @@ RECOMMENDATIONS = [
     "📗 <b>«Adolat izlab» — tarixiy qissa</b>\nHaq va nohaq o‘rtasida.",
     "📘 <b>«Sha’n yo‘li» — ijtimoiy roman</b>\nOr-nomusni saqlash.",
     "📙 <b>«So‘nggi qaror» — dramatik asar</b>\nHal qiluvchi tanlov.",
-    "📓 <b>«Inson bo‘lib qol» — falsafiy nasihat</b>\nAxloq va mas’uliyat."
-        "📕 <b>«Qorong‘u yo‘l» — tarixiy roman</b>\nZulm ostidagi inson tanlovi.",
+    "📓 <b>«Inson bo‘lib qol» — falsafiy nasihat</b>\nAxloq va mas’uliyat.",
+    "📕 <b>«Qorong‘u yo‘l» — tarixiy roman</b>\nZulm ostidagi inson tanlovi.",
     "📗 <b>«So‘nggi nafas» — dramatik asar</b>\nHayot va o‘lim orasidagi qaror.",
     "📘 <b>«Jimlik qichqirig‘i» — psixologik roman</b>\nAytilmagan dardlar hikoyasi.",
     "📙 <b>«Soya ichidagi nur» — badiiy asar</b>\nUmidni yo‘qotmaslik haqida.",
@@ -1296,8 +1295,8 @@ RECOMMENDATIONS = [
     "📗 <b>«Erkinlik sari» — tarixiy qissa</b>\nOzodlik uchun kurash.",
     "📘 <b>«Birlashtiruvchi kuch» — ijtimoiy asar</b>\nHamjihatlik ahamiyati.",
     "📙 <b>«Sabr bilan yengish» — ruhiy asar</b>\nSinovlar ortidan g‘alaba.",
-    "📓 <b>«Umr sabog‘i» — nasriy to‘plam</b>\nHayotdan o‘rganilgan haqiqatlar."
-        "📕 <b>«Qalb ko‘zgusi» — badiiy-falsafiy asar</b>\nInson o‘zini anglash yo‘lida.",
+    "📓 <b>«Umr sabog‘i» — nasriy to‘plam</b>\nHayotdan o‘rganilgan haqiqatlar.",
+    "📕 <b>«Qalb ko‘zgusi» — badiiy-falsafiy asar</b>\nInson o‘zini anglash yo‘lida.",
     "📗 <b>«Ichki bo‘ron» — psixologik roman</b>\nTashqi sokinlik ortidagi kurash.",
     "📘 <b>«Soya va nur» — badiiy asar</b>\nYaxshilik va yomonlik qarama-qarshiligi.",
     "📙 <b>«Hayot imtihoni» — dramatik roman</b>\nSinovlar orqali ulg‘ayish.",
@@ -1343,7 +1342,7 @@ RECOMMENDATIONS = [
     "📗 <b>«Sukutdan keyin» — dramatik asar</b>\nJimlikdan keyingi haqiqat.",
     "📘 <b>«Birgina lahza» — falsafiy qissa</b>\nBir qarorning kuchi.",
     "📙 <b>«O‘zing bilan yuzma-yuz» — psixologik kitob</b>\nO‘zini tanish.",
-    "📓 <b>«Umid bilan» — ruhiy asar</b>\nTaslim bo‘lmaslik."
+    "📓 <b>«Umid bilan» — ruhiy asar</b>\nTaslim bo‘lmaslik.",
     # --- JAHON KLASSIKASI ---
     "📕 <b>«Graf Monte-Kristo» — Aleksandr Dyuma</b>\nSadoqat, xiyonat va qasos haqida buyuk sarguzasht.",
     "📗 <b>«Uch mushketyor» — Aleksandr Dyuma</b>\nDo‘stlik va mardlik haqida o‘lmas asar.",
@@ -1357,7 +1356,6 @@ RECOMMENDATIONS = [
     "📙 <b>«Dorian Grey portreti» — Oskar Uayld</b>\nGo‘zallik, yoshlik va vijdon azobi haqida.",
     "📓 <b>«Farengeyt bo‘yicha 451 daraja» — Rey Bredberi</b>\nKitoblar yoqiladigan kelajak haqida ogohlantirish.",
 
-    "📕 <b>«Martin Iden» — Jek London</b>\nOddiy yigitning yozuvchi bo‘lish yo‘lidagi mashaqqatlari.",
     "📗 <b>«Oqso‘yloq» — Jek London</b>\nTabiat va inson o‘rtasidagi do‘stlik.",
     "📘 <b>«Hayotga muhabbat» — Jek London</b>\nYashash ishtiyoqi haqida kuchli hikoya.",
     "📙 <b>«Xo‘rlanganlar va haqoratlanganlar» — Fyodor Dostoyevskiy</b>\nOddiy insonlarning fojiali taqdiri.",
@@ -1392,7 +1390,6 @@ RECOMMENDATIONS = [
     "📕 <b>«Lolazor» — Murod Muhammad Do‘st</b>\nO‘tish davri muammolari haqida roman.",
     "📗 <b>«Galatepaga qaytish» — Murod Muhammad Do‘st</b>\nQishloq hayoti va sog‘inch.",
     "📘 <b>«Chinor» — Asqad Muxtor</b>\nAvlodlar silsilasi va oila mustahkamligi.",
-    "📙 <b>«Tushda kechgan umrlar» — O‘tkir Hoshimov</b>\nQatag‘on yillari fojeasi.",
     "📓 <b>«Jinlar bazmi» — Abdulla Qodiriy</b>\nJamiyat illatlarini fosh etuvchi hikoya.",
 
     # --- TURK VA SHARQ ADABIYOTI ---
@@ -1,208 +1,1317 @@
 
 import aiosqlite
+import asyncio
 import datetime
+import hashlib
 import json
 import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
 
-class DatabaseManager:
-    def __init__(self, db_name="kitobxon_pro.db"):
+from catalog import CatalogCache
+from fuzzy import FuzzyIndex
+from rank import RankIndex
+from recommend import ContentIndex, CoReadIndex, Recommender
+from search import PrefixIndex, fts_query, normalize_text
+
+# The rollback journal writes straight into the database file. WAL keeps
+# recent commits in a -wal file next to it, so it is only safe where that
+# file persists too: docker-compose.yml mounts the database file alone.
+PRAGMAS = {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "busy_timeout": 5000,
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -16000,  # ~16 MB per connection
+    "temp_store": "MEMORY",
+}
+
+class ConnectionPool:
+    """Process-wide aiosqlite connections: N readers plus one writer.
+
+    Reads are spread over the reader connections while every write is
+    serialized through the writer connection. With journal_mode=WAL the
+    readers also run alongside a commit instead of waiting on busy_timeout.
+    """
+
+    def __init__(self, db_name, readers=4, pragmas=None):
         self.db_name = db_name
+        self.size = max(1, readers)
+        self.pragmas = dict(PRAGMAS, **(pragmas or {}))
+        self._readers = []
+        self._writer = None
+        self._idle = None
+        self._write_lock = None
+        self._loop = None
+        self._open_lock = None
+        self.stats_data = {
+            "acquired": 0, "waited": 0, "wait_total": 0.0, "wait_max": 0.0,
+            "in_use": 0, "peak_in_use": 0,
+            "writes": 0, "write_waited": 0, "write_wait_total": 0.0, "write_wait_max": 0.0,
+        }
 
-    async def create_tables(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('''CREATE TABLE IF NOT EXISTS users 
-                (user_id INTEGER PRIMARY KEY, fullname TEXT, quiz_points INTEGER DEFAULT 0, 
-                streak INTEGER DEFAULT 0, last_active DATE, clan TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS books 
-                (id INTEGER PRIMARY KEY, title TEXT, author TEXT, desc TEXT, questions TEXT, category TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS read_books 
-                (id INTEGER PRIMARY KEY, user_id INTEGER, book_name TEXT, date TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS library_files 
-                (id INTEGER PRIMARY KEY, title TEXT, file_id TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS tracker 
-                (id INTEGER PRIMARY KEY, user_id INTEGER, pages INTEGER, date DATE)''')
-            await db.execute("CREATE TABLE IF NOT EXISTS memory (id INTEGER PRIMARY KEY, user_id INTEGER, title TEXT, content TEXT, file_id TEXT, file_type TEXT)")
-            
-            # Migration: Add category column if missing
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.db_name)
+        for name, value in self.pragmas.items():
+            await conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _bind_loop(self):
+        # asyncio primitives belong to the loop that first used them
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        self._loop = loop
+        self._open_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._idle = asyncio.Queue()
+        for conn in self._readers:
+            self._idle.put_nowait(conn)
+
+    async def open(self):
+        self._bind_loop()
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # The writer goes first so the journal mode is set before readers attach
+            self._writer = await self._connect()
+            for _ in range(self.size):
+                conn = await self._connect()
+                self._readers.append(conn)
+                self._idle.put_nowait(conn)
+            logging.info("DB pool opened: %s readers + 1 writer on %s", self.size, self.db_name)
+
+    @asynccontextmanager
+    async def reader(self):
+        await self.open()
+        stats = self.stats_data
+        started = time.perf_counter()
+        if self._idle.empty():
+            stats["waited"] += 1
+        conn = await self._idle.get()
+        waited = time.perf_counter() - started
+        stats["acquired"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        stats["in_use"] += 1
+        stats["peak_in_use"] = max(stats["peak_in_use"], stats["in_use"])
+        try:
+            yield conn
+        finally:
+            stats["in_use"] -= 1
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        await self.open()
+        stats = self.stats_data
+        started = time.perf_counter()
+        if self._write_lock.locked():
+            stats["write_waited"] += 1
+        async with self._write_lock:
+            waited = time.perf_counter() - started
+            stats["writes"] += 1
+            stats["write_wait_total"] += waited
+            stats["write_wait_max"] = max(stats["write_wait_max"], waited)
             try:
-                await db.execute("ALTER TABLE books ADD COLUMN category TEXT")
-            except:
-                pass # Column likely exists
-            
+                yield self._writer
+            except Exception:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                raise
+
+    def stats(self):
+        s = dict(self.stats_data)
+        s["size"] = self.size
+        s["idle"] = self._idle.qsize() if self._idle else 0
+        s["saturation"] = s["waited"] / s["acquired"] if s["acquired"] else 0.0
+        s["wait_avg_ms"] = s["wait_total"] / s["acquired"] * 1000 if s["acquired"] else 0.0
+        s["write_wait_avg_ms"] = s["write_wait_total"] / s["writes"] * 1000 if s["writes"] else 0.0
+        return s
+
+    async def close(self):
+        if self._writer is None:
+            return
+        self._bind_loop()
+        async with self._write_lock:
+            # Wait for borrowed readers to come back before closing them
+            for _ in range(len(self._readers)):
+                conn = await self._idle.get()
+                await conn.close()
+            await self._writer.execute("PRAGMA optimize")
+            # Fold any WAL content into the database file before it goes away
+            await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await self._writer.close()
+            self._readers = []
+            self._writer = None
+        logging.info("DB pool closed: %s", self.stats())
+
+# PRAGMA synchronous per write durability mode under WAL, see WriteQueue
+DURABILITY = {"full": "FULL", "normal": "NORMAL", "async": "NORMAL"}
+
+class WriteQueue:
+    """Write-behind queue: small writes from many handlers, one commit per batch.
+
+    A job is a coroutine function taking the writer connection; it must not
+    commit. A batch takes what arrives within `max_delay` of its first job,
+    at most `max_batch` jobs, and runs them in one transaction. If a job
+    raises, the batch is rolled back and redone with a savepoint per job,
+    so only the failing job is lost. `durability` decides when the caller
+    gets the job's result:
+      "full"   - after the commit, made with synchronous=FULL
+      "normal" - after the commit (synchronous=NORMAL under WAL)
+      "async"  - once the batch has run, before its commit, so a crash
+                 can lose the last batch
+    post() queues a job without waiting for it at all. close() commits
+    everything still queued.
+    """
+
+    def __init__(self, pool, durability="normal", max_batch=256, max_delay=0.005, max_pending=4096):
+        if durability not in DURABILITY:
+            raise ValueError(f"unknown durability: {durability}")
+        self.pool = pool
+        self.durability = durability
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._queue = None
+        self._task = None
+        self._loop = None
+        self._closed = False
+        self._posting = set()  # post() calls waiting for room in a full queue
+        self.stats_data = {"jobs": 0, "failed": 0, "batches": 0, "batch_max": 0, "commit_total": 0.0}
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        self._loop = loop
+        self._closed = False
+        self._queue = asyncio.Queue(self.max_pending)
+        self._task = loop.create_task(self._run())
+
+    async def submit(self, job):
+        """Queue `job` and return its result (see `durability` for when)."""
+        self._bind_loop()
+        if self._closed:
+            raise RuntimeError("write queue is closed")
+        future = self._loop.create_future()
+        await self._queue.put((job, future))
+        return await future
+
+    def post(self, job):
+        """Queue `job` and return at once; a failure is only logged."""
+        self._bind_loop()
+        if self._closed:
+            raise RuntimeError("write queue is closed")
+        future = self._loop.create_future()
+        future.add_done_callback(self._log_failure)
+        try:
+            self._queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            task = self._loop.create_task(self._queue.put((job, future)))
+            self._posting.add(task)
+            task.add_done_callback(self._posting.discard)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("Queued write failed: %s", future.exception())
+
+    async def _run(self):
+        stop = False
+        while not stop or not self._queue.empty():
+            batch = []
+            if not stop:
+                item = await self._queue.get()
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+                    if self.max_delay:
+                        # Let the rest of a burst join this batch
+                        await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                await self._commit(batch)
+
+    @staticmethod
+    def _settle(future, result=None, error=None):
+        if future.done():  # the caller gave up waiting
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def _run_jobs(self, db, batch, isolate):
+        done = []
+        for job, future in batch:
+            if not isolate:
+                done.append((future, await job(db)))
+                continue
+            await db.execute("SAVEPOINT job")
+            try:
+                done.append((future, await job(db)))
+            except Exception as e:
+                await db.execute("ROLLBACK TO job")
+                self.stats_data["failed"] += 1
+                self._settle(future, error=e)
+            await db.execute("RELEASE job")
+        return done
+
+    async def _commit(self, batch):
+        stats = self.stats_data
+        started = time.perf_counter()
+        try:
+            async with self.pool.writer() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                try:
+                    done = await self._run_jobs(db, batch, isolate=False)
+                except Exception:
+                    await db.rollback()
+                    await db.execute("BEGIN IMMEDIATE")
+                    done = await self._run_jobs(db, batch, isolate=True)
+                if self.durability == "async":
+                    for future, result in done:
+                        self._settle(future, result)
+                await db.commit()
+        except Exception as e:
+            logging.error("Write batch of %s jobs failed: %s", len(batch), e)
+            stats["failed"] += len(batch)
+            for _, future in batch:
+                self._settle(future, error=e)
+            return
+        for future, result in done:
+            self._settle(future, result)
+        stats["jobs"] += len(batch)
+        stats["batches"] += 1
+        stats["batch_max"] = max(stats["batch_max"], len(batch))
+        stats["commit_total"] += time.perf_counter() - started
+
+    def stats(self):
+        s = dict(self.stats_data)
+        s["durability"] = self.durability
+        s["pending"] = self._queue.qsize() if self._queue else 0
+        s["batch_avg"] = s["jobs"] / s["batches"] if s["batches"] else 0.0
+        s["commit_avg_ms"] = s["commit_total"] / s["batches"] * 1000 if s["batches"] else 0.0
+        return s
+
+    async def close(self):
+        """Stop taking jobs and wait until everything queued is committed."""
+        if self._task is None or self._closed:
+            return
+        self._closed = True
+        if self._posting:
+            await asyncio.gather(*self._posting)
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+def book_hash(title, author, desc, questions_json, category):
+    payload = json.dumps([title, author, desc, questions_json, category], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def quiz_hash(questions_json):
+    return hashlib.sha1((questions_json or "").encode("utf-8")).hexdigest()
+
+def question_rows(book_id, questions):
+    """Flatten a quiz list into quiz_questions rows with the answer index resolved."""
+    rows = []
+    for position, q in enumerate(questions):
+        opts = list(q.get('opts', []))
+        correct_idx = opts.index(q['ans']) if q.get('ans') in opts else -1
+        rows.append((book_id, position, q.get('q', ''), json.dumps(opts, ensure_ascii=False), correct_idx))
+    return rows
+
+async def write_questions(db, book_id, questions):
+    # Positions are dense (0..n-1) so sampling can pick them without a scan.
+    # Rows are upserted in place: ids held by live quiz sessions stay valid,
+    # and answer stats survive unless the question text itself changed.
+    rows = question_rows(book_id, questions)
+    await db.executemany('''INSERT INTO quiz_questions (book_id, position, question, opts, correct_idx) VALUES (?, ?, ?, ?, ?) 
+        ON CONFLICT (book_id, position) DO UPDATE SET 
+            shown = CASE WHEN question = excluded.question THEN shown ELSE 0 END, 
+            correct = CASE WHEN question = excluded.question THEN correct ELSE 0 END, 
+            question = excluded.question, opts = excluded.opts, correct_idx = excluded.correct_idx''', rows)
+    await db.execute("DELETE FROM quiz_questions WHERE book_id=? AND position >= ?", (book_id, len(rows)))
+    await db.execute("UPDATE books SET question_count=? WHERE id=?", (len(rows), book_id))
+
+def period_keys(day):
+    """points_periods keys for the ISO week and the month containing `day`."""
+    year, week, _ = day.isocalendar()
+    return f"w{year}-{week:02d}", f"m{day.year}-{day.month:02d}"
+
+async def write_search_row(db, book_id, title, author, desc):
+    # books_fts holds normalized copies; rowid is the book id
+    await db.execute("DELETE FROM books_fts WHERE rowid=?", (book_id,))
+    await db.execute("INSERT INTO books_fts (rowid, title, author, desc) VALUES (?, ?, ?, ?)",
+                     (book_id, normalize_text(title), normalize_text(author), normalize_text(desc)))
+
+def book_text(title, desc, questions):
+    # What the content index reads for a book: title, description, quiz text
+    parts = [title or "", desc or ""]
+    for q in questions:
+        parts.append(q.get('q', ''))
+        parts.extend(q.get('opts', []))
+    return " ".join(parts)
+
+async def write_similar(db, neighbors, book_ids):
+    await db.executemany("DELETE FROM book_similar WHERE book_id=?", [(book_id,) for book_id in book_ids])
+    rows = [(book_id, rank, other, score) for book_id in book_ids for rank, (score, other) in enumerate(neighbors.get(book_id, ()))]
+    await db.executemany("INSERT INTO book_similar (book_id, rank, similar_id, score) VALUES (?, ?, ?, ?)", rows)
+
+async def leave_clan_row(db, clan, points, books_read):
+    # Take one member's share out of a clan's totals; empty clans go away
+    await db.execute("UPDATE clans SET members = members - 1, points = points - ?, books_read = books_read - ? WHERE name=?",
+                     (points, books_read, clan))
+    await db.execute("DELETE FROM clans WHERE name=? AND members <= 0", (clan,))
+
+# --- SCHEMA MIGRATIONS ---
+# Each migration runs in its own transaction and bumps PRAGMA user_version,
+# so a failed step leaves the schema at the previous version. Append new
+# steps at the end; never edit or reorder one that has shipped.
+
+async def _columns(db, table):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+async def _m001_base_schema(db):
+    await db.execute('''CREATE TABLE IF NOT EXISTS users 
+        (user_id INTEGER PRIMARY KEY, fullname TEXT, quiz_points INTEGER DEFAULT 0, 
+        streak INTEGER DEFAULT 0, last_active DATE, clan TEXT)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS books 
+        (id INTEGER PRIMARY KEY, title TEXT, author TEXT, desc TEXT, questions TEXT, category TEXT)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS read_books 
+        (id INTEGER PRIMARY KEY, user_id INTEGER, book_name TEXT, date TEXT)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS library_files 
+        (id INTEGER PRIMARY KEY, title TEXT, file_id TEXT)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS tracker 
+        (id INTEGER PRIMARY KEY, user_id INTEGER, pages INTEGER, date DATE)''')
+    await db.execute("CREATE TABLE IF NOT EXISTS memory (id INTEGER PRIMARY KEY, user_id INTEGER, title TEXT, content TEXT, file_id TEXT, file_type TEXT)")
+    # Databases created before the category column existed
+    if "category" not in await _columns(db, "books"):
+        await db.execute("ALTER TABLE books ADD COLUMN category TEXT")
+
+async def _m002_indexes(db):
+    # read_books: per-user history (ORDER BY date) and the leaderboard count
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_read_books_user ON read_books (user_id, date)")
+    # tracker: SUM(pages) for one user and day, answered from the index alone
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tracker_user_date ON tracker (user_id, date, pages)")
+    # books: title IN (...) lookups and per-category recommendations
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_books_title ON books (title)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_books_category ON books (category)")
+    # users: leaderboard ORDER BY quiz_points DESC LIMIT 10
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_points ON users (quiz_points)")
+    await db.execute("ANALYZE")
+
+async def _m003_catalog_sync(db):
+    # source_key ties a row to its LIBRARY_DATA key; content_hash lets the
+    # startup sync skip books that did not change
+    columns = await _columns(db, "books")
+    if "source_key" not in columns:
+        await db.execute("ALTER TABLE books ADD COLUMN source_key INTEGER")
+    if "content_hash" not in columns:
+        await db.execute("ALTER TABLE books ADD COLUMN content_hash TEXT")
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_books_source_key ON books (source_key)")
+
+async def _m004_quiz_questions(db):
+    await db.execute('''CREATE TABLE IF NOT EXISTS quiz_questions 
+        (id INTEGER PRIMARY KEY, book_id INTEGER NOT NULL, position INTEGER NOT NULL, question TEXT, 
+        opts TEXT, correct_idx INTEGER, shown INTEGER DEFAULT 0, correct INTEGER DEFAULT 0)''')
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_quiz_questions_book ON quiz_questions (book_id, position)")
+    if "question_count" not in await _columns(db, "books"):
+        await db.execute("ALTER TABLE books ADD COLUMN question_count INTEGER DEFAULT 0")
+    async with db.execute("SELECT id, questions FROM books") as cursor:
+        books = await cursor.fetchall()
+    for book_id, q_json in books:
+        try:
+            questions = json.loads(q_json) if q_json else []
+        except ValueError:
+            logging.warning("Book %s has malformed quiz JSON, skipped", book_id)
+            questions = []
+        await write_questions(db, book_id, questions)
+
+async def _m005_quiz_sessions(db):
+    # Checkpointed live quizzes; question_ids is a comma-separated id list
+    await db.execute('''CREATE TABLE IF NOT EXISTS quiz_sessions 
+        (user_id INTEGER PRIMARY KEY, book_id INTEGER, book_title TEXT, question_ids TEXT, 
+        q_idx INTEGER, score INTEGER, touched REAL)''')
+
+async def _m006_books_fts(db):
+    # Prefix indexes keep "o'tk*"-style queries off a full term scan
+    await db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5 
+        (title, author, desc, tokenize="unicode61 remove_diacritics 2", prefix="2 3")''')
+    async with db.execute("SELECT id, title, author, desc FROM books") as cursor:
+        books = await cursor.fetchall()
+    for book_id, title, author, desc in books:
+        await write_search_row(db, book_id, title, author, desc)
+
+async def _m007_fts_transliteration(db):
+    # normalize_text now folds Cyrillic to Latin; rewrite the stored keys
+    async with db.execute("SELECT id, title, author, desc FROM books") as cursor:
+        books = await cursor.fetchall()
+    for book_id, title, author, desc in books:
+        await write_search_row(db, book_id, title, author, desc)
+
+async def _m008_read_counts(db):
+    # Per-user read count kept by add_read_book instead of a COUNT(*) per row
+    if "books_read" not in await _columns(db, "users"):
+        await db.execute("ALTER TABLE users ADD COLUMN books_read INTEGER DEFAULT 0")
+    await db.execute('''UPDATE users SET books_read = 
+        (SELECT COUNT(*) FROM read_books WHERE read_books.user_id = users.user_id)''')
+
+async def _m009_points_ledger(db):
+    # Every award is appended; points_periods holds running per-week and
+    # per-month totals so windowed leaderboards never scan the ledger
+    await db.execute('''CREATE TABLE IF NOT EXISTS points_ledger 
+        (id INTEGER PRIMARY KEY, user_id INTEGER, points INTEGER, ts REAL)''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_points_ledger_ts ON points_ledger (ts)")
+    await db.execute('''CREATE TABLE IF NOT EXISTS points_periods 
+        (period TEXT, user_id INTEGER, points INTEGER, PRIMARY KEY (period, user_id)) WITHOUT ROWID''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_points_periods_rank ON points_periods (period, points)")
+
+async def _m010_clans(db):
+    # Running totals per clan, kept by the same writes that change a member
+    await db.execute('''CREATE TABLE IF NOT EXISTS clans 
+        (name TEXT PRIMARY KEY COLLATE NOCASE, members INTEGER, points INTEGER, books_read INTEGER)''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_clans_points ON clans (points)")
+    await db.execute('''INSERT OR IGNORE INTO clans (name, members, points, books_read) 
+        SELECT clan, COUNT(*), SUM(quiz_points), SUM(books_read) FROM users WHERE clan IS NOT NULL GROUP BY clan''')
+
+async def _m011_read_book_ids(db):
+    # Read history keyed by book id; titles were the only link before
+    if "book_id" not in await _columns(db, "read_books"):
+        await db.execute("ALTER TABLE read_books ADD COLUMN book_id INTEGER")
+    # Old rows are free text; link the ones whose title matches after normalization
+    async with db.execute("SELECT id, title FROM books ORDER BY id DESC") as cursor:
+        by_title = {normalize_text(title): book_id for book_id, title in await cursor.fetchall()}
+    async with db.execute("SELECT DISTINCT book_name FROM read_books WHERE book_id IS NULL") as cursor:
+        names = [row[0] for row in await cursor.fetchall()]
+    links = [(by_title[normalize_text(name)], name) for name in names if normalize_text(name) in by_title]
+    await db.executemany("UPDATE read_books SET book_id=? WHERE book_name=? AND book_id IS NULL", links)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_read_books_user_book ON read_books (user_id, book_id)")
+
+async def _m012_book_similar(db):
+    # Precomputed content neighbours, rank 0 = most similar
+    await db.execute('''CREATE TABLE IF NOT EXISTS book_similar 
+        (book_id INTEGER, rank INTEGER, similar_id INTEGER, score REAL, PRIMARY KEY (book_id, rank)) WITHOUT ROWID''')
+
+async def _m013_recommendation_bags(db):
+    # Per-user position in a seeded permutation of the recommendation pool
+    await db.execute('''CREATE TABLE IF NOT EXISTS recommendation_bags 
+        (user_id INTEGER PRIMARY KEY, seed INTEGER, cursor INTEGER, size INTEGER)''')
+
+async def _m014_quiz_hash(db):
+    # Hash of the quiz JSON alone, so a sync rewrites questions only when they change
+    if "quiz_hash" not in await _columns(db, "books"):
+        await db.execute("ALTER TABLE books ADD COLUMN quiz_hash TEXT")
+    async with db.execute("SELECT id, questions FROM books") as cursor:
+        rows = [(quiz_hash(q_json), book_id) for book_id, q_json in await cursor.fetchall()]
+    await db.executemany("UPDATE books SET quiz_hash=? WHERE id=?", rows)
+
+MIGRATIONS = [
+    (1, "base schema", _m001_base_schema),
+    (2, "secondary indexes", _m002_indexes),
+    (3, "catalog sync keys", _m003_catalog_sync),
+    (4, "normalized quiz questions", _m004_quiz_questions),
+    (5, "quiz session checkpoints", _m005_quiz_sessions),
+    (6, "full-text book search", _m006_books_fts),
+    (7, "transliterated search keys", _m007_fts_transliteration),
+    (8, "materialized read counts", _m008_read_counts),
+    (9, "points ledger and period totals", _m009_points_ledger),
+    (10, "clan totals", _m010_clans),
+    (11, "read history by book id", _m011_read_book_ids),
+    (12, "similar books", _m012_book_similar),
+    (13, "recommendation shuffle bags", _m013_recommendation_bags),
+    (14, "quiz content hashes", _m014_quiz_hash),
+]
+
+async def migrate(db):
+    async with db.execute("PRAGMA user_version") as cursor:
+        current = (await cursor.fetchone())[0]
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {version}")
             await db.commit()
+        except Exception:
+            await db.rollback()
+            logging.error("Migration %s (%s) failed, schema stays at v%s", version, name, current)
+            raise
+        current = version
+        logging.info("Schema migrated to v%s: %s", version, name)
+    return current
+
+class DatabaseManager:
+    def __init__(self, db_name="kitobxon_pro.db", readers=4, leaderboard_size=10,
+                 durability="normal", write_batch=256, write_delay=0.005, journal_mode="DELETE"):
+        self.db_name = db_name
+        # synchronous=NORMAL is only crash-safe under WAL; the rollback
+        # journal keeps SQLite's FULL default whatever the durability mode
+        wal = journal_mode.upper() == "WAL"
+        pragmas = {"journal_mode": journal_mode, "synchronous": DURABILITY.get(durability, "NORMAL") if wal else "FULL"}
+        self.pool = ConnectionPool(db_name, readers, pragmas)
+        # Hot single-row writes (points, reads, answers, logs) are group-committed
+        self.writes = WriteQueue(self.pool, durability, write_batch, write_delay)
+        self.catalog = CatalogCache()
+        self._catalog_lock = asyncio.Lock()
+        self._pdf_count = None
+        self.library_version = 0  # bumped on every library_files write
+        # In-memory search over book titles, authors and PDF titles: a
+        # typo/script-tolerant index and an as-you-type prefix index. Keys
+        # are ("book", id) and ("pdf", id); built together on first use.
+        self.fuzzy = None
+        self.prefix = None
+        self._pdf_files = {}  # library_files id -> Telegram file_id
+        self._search_lock = asyncio.Lock()
+        # Top-N snapshots per board ("all" or a points_periods key), as
+        # [(user_id, fullname, points, streak, books_read), ...]; dropped only
+        # by writes that can change them. Each board's version moves with it.
+        self.leaderboard_size = leaderboard_size
+        self._tops = {}
+        self.leaderboard_versions = defaultdict(int)
+        # Everyone's position by quiz_points; loaded once, then kept in step
+        # by add_user and update_points
+        self.ranks = None
+        self._points_version = 0
+        self._ranks_lock = asyncio.Lock()
+        # user_id -> (fullname, last_active) as last written, so a repeated
+        # /start skips the database; warmed by load_known_users
+        self.known_users = {}
+        # Candidate arrays per category, rebuilt when the catalog version moves
+        self.recommender = Recommender()
+        self._reads_version = 0
+        # "Readers also read" neighbours; built by rebuild_coreads, then
+        # updated by add_read_book
+        self.coreads = None
+        # Content neighbours {book id: [similar ids]} served from book_similar.
+        # The TF-IDF vectors behind them exist only after a rebuild; until
+        # then a new book marks the table stale instead.
+        self.similar = None
+        self.content = None
+        self._similar_stale = False
+        self._similar_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.writes.close()
+        await self.pool.close()
+
+    async def create_tables(self):
+        async with self.pool.writer() as db:
+            await migrate(db)
+
+    async def load_known_users(self):
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT user_id, fullname, last_active FROM users") as cursor:
+                rows = await cursor.fetchall()
+        # Entries written while the query ran are newer; keep them
+        for user_id, fullname, last_active in rows:
+            self.known_users.setdefault(user_id, (fullname, last_active))
+        return len(self.known_users)
 
     async def add_user(self, user_id, fullname):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT * FROM users WHERE user_id=?", (user_id,)) as cursor:
-                user = await cursor.fetchone()
-                if not user:
-                    await db.execute("INSERT INTO users (user_id, fullname, quiz_points, streak, last_active) VALUES (?, ?, 0, 0, ?)", 
-                                          (user_id, fullname, datetime.date.today()))
-                    await db.commit()
+        """Register the user, or refresh their name and last_active. A user
+        already seen today under the same name costs no query."""
+        today = str(datetime.date.today())
+        old = self.known_users.get(user_id)
+        if old == (fullname, today):
+            return
+        async def write(db):
+            query = '''INSERT INTO users (user_id, fullname, quiz_points, streak, last_active) VALUES (?, ?, 0, 0, ?) 
+                ON CONFLICT (user_id) DO UPDATE SET fullname = excluded.fullname, last_active = excluded.last_active 
+                RETURNING quiz_points'''
+            async with db.execute(query, (user_id, fullname, today)) as cursor:
+                return (await cursor.fetchone())[0]
+        points = await self.writes.submit(write)
+        self.known_users[user_id] = (fullname, today)
+        if old is None:
+            self._top_changed("all", user_id, points)
+            self._rank_changed(user_id, points)
+        if old is None or old[0] != fullname:
+            # Names are part of every board snapshot
+            for board in list(self.leaderboard_versions):
+                self._top_changed(board, user_id)
 
     async def get_user_stats(self, user_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT * FROM users WHERE user_id=?", (user_id,)) as cursor:
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT user_id, fullname, quiz_points, streak, last_active, clan FROM users WHERE user_id=?", (user_id,)) as cursor:
                 return await cursor.fetchone()
 
     async def update_points(self, user_id, points):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("UPDATE users SET quiz_points = quiz_points + ? WHERE user_id=?", (points, user_id))
-            await db.commit()
+        if not points:
+            return  # a zero-score quiz changes no total and must not put the user on a period board
+        # The all-time total, the ledger row and both period totals move together
+        async def write(db):
+            totals = {}
+            async with db.execute("UPDATE users SET quiz_points = quiz_points + ? WHERE user_id=? RETURNING quiz_points, clan", (points, user_id)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                if row[1] is not None:
+                    await db.execute("UPDATE clans SET points = points + ? WHERE name=?", (points, row[1]))
+                await db.execute("INSERT INTO points_ledger (user_id, points, ts) VALUES (?, ?, ?)", (user_id, points, time.time()))
+                for period in period_keys(datetime.date.today()):
+                    query = '''INSERT INTO points_periods (period, user_id, points) VALUES (?, ?, ?) 
+                        ON CONFLICT (period, user_id) DO UPDATE SET points = points + excluded.points RETURNING points'''
+                    async with db.execute(query, (period, user_id, points)) as cursor:
+                        totals[period] = (await cursor.fetchone())[0]
+            return row, totals
+        row, totals = await self.writes.submit(write)
+        if row:
+            self._top_changed("all", user_id, row[0])
+            for period, total in totals.items():
+                self._top_changed(period, user_id, total)
+            self._rank_changed(user_id, row[0])
+
+    def _rank_changed(self, user_id, points):
+        self._points_version += 1
+        if self.ranks is not None:
+            self.ranks.set(user_id, points)
+
+    async def rank_index(self):
+        if self.ranks is None:
+            async with self._ranks_lock:
+                while self.ranks is None:
+                    version = self._points_version
+                    async with self.pool.reader() as db:
+                        async with db.execute("SELECT user_id, quiz_points FROM users") as cursor:
+                            rows = await cursor.fetchall()
+                    if version == self._points_version:
+                        ranks = RankIndex()
+                        ranks.load(rows)
+                        self.ranks = ranks
+        return self.ranks
+
+    async def get_rank(self, user_id):
+        """(rank, total, ahead, behind) for a user, or None if unknown.
+
+        `ahead` / `behind` are (fullname, points) of the nearest users with
+        more / fewer points, or None at either end.
+        """
+        ranks = await self.rank_index()
+        position = ranks.rank(user_id)
+        if position is None:
+            return None
+        ahead, behind = ranks.neighbors(user_id)
+        ids = [n[0] for n in (ahead, behind) if n]
+        names = {}
+        if ids:
+            async with self.pool.reader() as db:
+                query = f"SELECT user_id, fullname FROM users WHERE user_id IN ({','.join('?' * len(ids))})"
+                async with db.execute(query, ids) as cursor:
+                    names = dict(await cursor.fetchall())
+        ahead = (names.get(ahead[0]), ahead[1]) if ahead else None
+        behind = (names.get(behind[0]), behind[1]) if behind else None
+        return position + (ahead, behind)
+
+    def _top_changed(self, board, user_id, points=None):
+        """Drop a leaderboard snapshot if this user's write can change it."""
+        top = self._tops.get(board)
+        if top is None:
+            self.leaderboard_versions[board] += 1  # a snapshot being read now is stale
+            return
+        in_top = any(row[0] == user_id for row in top)
+        if in_top or (points is not None and (len(top) < self.leaderboard_size or points >= top[-1][2])):
+            del self._tops[board]
+            self.leaderboard_versions[board] += 1
 
     # --- BOOK & QUIZ METHODS ---
     async def add_book_with_quiz(self, title, author, desc, questions_json, category="General"):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("INSERT INTO books (title, author, desc, questions, category) VALUES (?, ?, ?, ?, ?)", 
+        async with self.pool.writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute("INSERT INTO books (title, author, desc, questions, category) VALUES (?, ?, ?, ?, ?)", 
                                   (title, author, desc, questions_json, category))
+            await write_questions(db, cursor.lastrowid, json.loads(questions_json))
+            await write_search_row(db, cursor.lastrowid, title, author, desc)
+            changed = ()
+            if self.content is not None:
+                changed = self.content.add(cursor.lastrowid, book_text(title, desc, json.loads(questions_json)))
+                await write_similar(db, self.content.neighbors, changed)
             await db.commit()
+        self.catalog.invalidate()
+        self._index(("book", cursor.lastrowid), title, author)
+        if self.content is None:
+            self._similar_stale = True
+            self.similar = None
+        elif self.similar is not None:
+            for book_id in changed:
+                self.similar[book_id] = [other for _, other in self.content.neighbors[book_id]]
+
+    async def _catalog(self):
+        if not self.catalog.loaded:
+            async with self._catalog_lock:
+                while not self.catalog.loaded:
+                    version = self.catalog.version
+                    async with self.pool.reader() as db:
+                        async with db.execute("SELECT id, title, author, desc, category, question_count FROM books ORDER BY id") as cursor:
+                            rows = await cursor.fetchall()
+                    self.catalog.load(rows, version)
+        return self.catalog
 
     async def get_all_books(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT id, title, author FROM books") as cursor:
-                return await cursor.fetchall()
+        return (await self._catalog()).listing()
 
+    async def get_books_page(self, page, per_page=10):
+        return (await self._catalog()).page(page, per_page)
+
+    async def get_book(self, book_id):
+        # (id, title, author, desc, category, question_count) without the questions blob
+        return (await self._catalog()).get(book_id)
 
     async def get_book_details(self, book_id):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM books WHERE id=?", (book_id,)) as cursor:
                 return await cursor.fetchone()
 
+    async def sample_question_ids(self, book_id, n=10):
+        """Pick up to n random question ids, read from the (book_id, position) index alone."""
+        book = await self.get_book(book_id)
+        if not book or not book[5]:
+            return []
+        positions = random.sample(range(book[5]), min(n, book[5]))
+        placeholders = ','.join('?' for _ in positions)
+        query = f"SELECT id FROM quiz_questions WHERE book_id=? AND position IN ({placeholders})"
+        async with self.pool.reader() as db:
+            async with db.execute(query, [book_id] + positions) as cursor:
+                ids = [row[0] for row in await cursor.fetchall()]
+        random.shuffle(ids)
+        return ids
+
+    async def get_questions(self, question_ids):
+        """Questions for the given ids, in the same order, in one query."""
+        placeholders = ','.join('?' for _ in question_ids)
+        query = f"SELECT id, question, opts, correct_idx FROM quiz_questions WHERE id IN ({placeholders})"
+        async with self.pool.reader() as db:
+            async with db.execute(query, list(question_ids)) as cursor:
+                rows = {row[0]: row for row in await cursor.fetchall()}
+        return [(q_id, rows[q_id][1], json.loads(rows[q_id][2]), rows[q_id][3]) for q_id in question_ids if q_id in rows]
+
+    async def save_quiz_sessions(self, rows, finished):
+        if not rows and not finished:
+            return
+        async with self.pool.writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.executemany("INSERT OR REPLACE INTO quiz_sessions (user_id, book_id, book_title, question_ids, q_idx, score, touched) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            await db.executemany("DELETE FROM quiz_sessions WHERE user_id=?", [(user_id,) for user_id in finished])
+            await db.commit()
+
+    async def load_quiz_sessions(self):
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT user_id, book_id, book_title, question_ids, q_idx, score, touched FROM quiz_sessions") as cursor:
+                return await cursor.fetchall()
+
+    def record_answer(self, question_id, is_correct):
+        # Answer stats are not worth a wait on every tap: queued, not awaited
+        async def write(db):
+            await db.execute("UPDATE quiz_questions SET shown = shown + 1, correct = correct + ? WHERE id=?", (int(is_correct), question_id))
+        self.writes.post(write)
+
+    async def get_question_stats(self, book_id):
+        # Hardest questions first
+        async with self.pool.reader() as db:
+            query = "SELECT id, question, shown, correct FROM quiz_questions WHERE book_id=? ORDER BY CAST(correct AS REAL) / MAX(shown, 1), shown DESC"
+            async with db.execute(query, (book_id,)) as cursor:
+                return await cursor.fetchall()
+
     async def get_books_count(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT COUNT(*) FROM books") as cursor:
-                res = await cursor.fetchone()
-                return res[0] if res else 0
+        return (await self._catalog()).count()
 
-    async def search_books(self, query):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT id, title, author, desc FROM books WHERE title LIKE ? OR author LIKE ?", (f'%{query}%', f'%{query}%')) as cursor:
+    async def search_books(self, query, limit=10):
+        """Best matches as (id, title, author, desc), ranked by bm25 (title > author > desc)."""
+        match = fts_query(query)
+        if not match:
+            return []
+        sql = '''SELECT books.id, books.title, books.author, books.desc FROM books_fts 
+            JOIN books ON books.id = books_fts.rowid 
+            WHERE books_fts MATCH ? ORDER BY bm25(books_fts, 10.0, 5.0, 1.0) LIMIT ?'''
+        async with self.pool.reader() as db:
+            async with db.execute(sql, (match, limit)) as cursor:
                 return await cursor.fetchall()
+
+    async def search_indexes(self):
+        """Return (fuzzy, prefix), building both from the catalog and library_files once."""
+        if self.fuzzy is None:
+            async with self._search_lock:
+                while self.fuzzy is None:
+                    # A write during the build is not applied to it; start over
+                    versions = (self.catalog.version, self.library_version)
+                    fuzzy, prefix = FuzzyIndex(), PrefixIndex()
+                    for b_id, title, author, *_ in (await self._catalog()).books:
+                        fuzzy.add(("book", b_id), title, author)
+                        prefix.add(("book", b_id), title, author)
+                    async with self.pool.reader() as db:
+                        async with db.execute("SELECT id, title, file_id FROM library_files") as cursor:
+                            pdfs = await cursor.fetchall()
+                    for p_id, title, _ in pdfs:
+                        fuzzy.add(("pdf", p_id), title)
+                        prefix.add(("pdf", p_id), title)
+                    if versions == (self.catalog.version, self.library_version):
+                        self.prefix = prefix
+                        self._pdf_files = {p_id: file_id for p_id, _, file_id in pdfs}
+                        self.fuzzy = fuzzy
+        return self.fuzzy, self.prefix
+
+    def _index(self, key, *texts):
+        # Writes keep built indexes current; unbuilt ones pick them up later
+        if self.fuzzy is not None:
+            self.fuzzy.add(key, *texts)
+            self.prefix.add(key, *texts)
+
+    def _unindex(self, key):
+        if self.fuzzy is not None:
+            self.fuzzy.remove(key)
+            self.prefix.remove(key)
+
+    async def fuzzy_search(self, query, limit=10):
+        """Approximate matches as [(kind, id, title), ...]; kind is "book" or "pdf".
+
+        Tolerates typos and Cyrillic input; served from memory, no SQL.
+        """
+        index, _ = await self.search_indexes()
+        return [(kind, item_id, index.texts[(kind, item_id)][0])
+                for _, (kind, item_id) in index.search(query, limit)]
+
+    async def inline_search(self, query, offset=0, limit=50):
+        """One page of inline results plus the next offset (None on the last page).
+
+        Rows are ("book", id, title, author, desc) or ("pdf", id, title, file_id),
+        all from memory: no SQL per keystroke once the indexes are built.
+        """
+        _, prefix = await self.search_indexes()
+        keys, next_offset = prefix.search(query, offset, limit)
+        catalog = await self._catalog()
+        rows = []
+        for kind, item_id in keys:
+            if kind == "book":
+                book = catalog.get(item_id)
+                if book:
+                    rows.append(("book",) + book[:4])
+            elif item_id in self._pdf_files:
+                rows.append(("pdf", item_id, self.fuzzy.texts[("pdf", item_id)][0], self._pdf_files[item_id]))
+        return rows, next_offset
     
+    async def similar_index(self):
+        """{book id: [similar book ids]}, loaded from book_similar or rebuilt if stale."""
+        if self.similar is None:
+            async with self._similar_lock:
+                if self.similar is None and not self._similar_stale:
+                    async with self.pool.reader() as db:
+                        async with db.execute("SELECT book_id, similar_id FROM book_similar ORDER BY book_id, rank") as cursor:
+                            rows = await cursor.fetchall()
+                    if rows or await self.get_books_count() < 2:
+                        similar = defaultdict(list)
+                        for book_id, other in rows:
+                            similar[book_id].append(other)
+                        self.similar = dict(similar)
+                if self.similar is None:
+                    await self.rebuild_similar()
+        return self.similar
+
+    async def content_index(self):
+        """Build the TF-IDF vectors behind book_similar, so uploads update it
+        incrementally instead of marking it stale. Run at startup."""
+        async with self._similar_lock:
+            if self.content is None and self.similar is None:
+                await self.rebuild_similar()
+            elif self.content is None:
+                # The writer lock keeps uploads out until the vectors exist
+                async with self.pool.writer() as db:
+                    async with db.execute("SELECT id, title, desc, questions FROM books") as cursor:
+                        rows = await cursor.fetchall()
+                    index = ContentIndex()
+                    index.build({b_id: book_text(title, desc, json.loads(q or '[]')) for b_id, title, desc, q in rows})
+                    self.content = index
+        return self.content
+
+    async def rebuild_similar(self):
+        """Vectorize every book and rewrite book_similar in one transaction."""
+        async with self.pool.writer() as db:
+            async with db.execute("SELECT id, title, desc, questions FROM books") as cursor:
+                rows = await cursor.fetchall()
+            index = ContentIndex()
+            book_ids = index.build({b_id: book_text(title, desc, json.loads(q or '[]')) for b_id, title, desc, q in rows})
+            await db.execute("BEGIN IMMEDIATE")
+            await db.execute("DELETE FROM book_similar")
+            await write_similar(db, index.neighbors, book_ids)
+            await db.commit()
+        self.content = index
+        self.similar = {b_id: [other for _, other in top] for b_id, top in index.neighbors.items()}
+        self._similar_stale = False
+        logging.info("Similar-books index rebuilt for %s books", len(book_ids))
+
+    async def get_similar_books(self, book_id, limit=3):
+        """Up to `limit` (id, title, author) rows most similar to the book."""
+        similar = await self.similar_index()
+        catalog = await self._catalog()
+        rows = [catalog.get(other) for other in similar.get(book_id, ())]
+        return [row[:3] for row in rows if row][:limit]
+
+    async def rebuild_coreads(self):
+        """Batch pass over read history: co-read counts and top-K neighbours per book."""
+        while True:
+            version = self._reads_version
+            # Books that left the catalog are not counted
+            query = '''SELECT user_id, book_id FROM read_books WHERE book_id IN (SELECT id FROM books) 
+                GROUP BY user_id, book_id ORDER BY user_id, MAX(id)'''
+            async with self.pool.reader() as db:
+                async with db.execute(query) as cursor:
+                    rows = await cursor.fetchall()
+            if version == self._reads_version:
+                break
+        histories = defaultdict(list)
+        for user_id, book_id in rows:
+            histories[user_id].append(book_id)
+        coreads = CoReadIndex()
+        coreads.build(histories.values())
+        self.coreads = coreads
+        logging.info("Co-read index built: %s readers, %s books with neighbours", len(histories), len(coreads.neighbors))
+        return coreads
+
     async def get_recommendations(self, user_id):
-        # Intelligent recommendation logic
-        async with aiosqlite.connect(self.db_name) as db:
-            # 1. Get user's read history
-            async with db.execute("SELECT book_name FROM read_books WHERE user_id=?", (user_id,)) as cursor:
-                read_books = [row[0] for row in await cursor.fetchall()]
-            
-            # 2. Analyze categories (Simple heuristic: find category of read books)
-            # Since read_books only stores names, we try to match names in 'books' table to get categories.
-            favorite_category = None
-            if read_books:
-                placeholders = ','.join('?' for _ in read_books)
-                query = f"SELECT category, COUNT(*) as cnt FROM books WHERE title IN ({placeholders}) GROUP BY category ORDER BY cnt DESC LIMIT 1"
-                async with db.execute(query, read_books) as cursor:
-                    res = await cursor.fetchone()
-                    if res: favorite_category = res[0]
-            
-            # 3. Recommend
-            if favorite_category:
-                # Recommend unread books from same category
-                placeholders = ','.join('?' for _ in read_books) if read_books else "''"
-                query = f"SELECT title, author, desc FROM books WHERE category=? AND title NOT IN ({placeholders}) ORDER BY RANDOM() LIMIT 1"
-                params = [favorite_category] + read_books
-                async with db.execute(query, params) as cursor:
-                    rec = await cursor.fetchone()
-                    if rec: return f"🎯 <b>Siz uchun maxsus:</b>\n\n📘 {rec[0]}\n✍️ {rec[1]}\n\n{rec[2]}"
-
-            # Fallback: Random book not read
-            placeholders = ','.join('?' for _ in read_books) if read_books else "''"
-            query = f"SELECT title, author, desc FROM books WHERE title NOT IN ({placeholders}) ORDER BY RANDOM() LIMIT 1"
-            async with db.execute(query, read_books) as cursor:
-                rec = await cursor.fetchone()
-                if rec: return f"🎲 <b>Tasodifiy tavsiya:</b>\n\n📘 {rec[0]}\n✍️ {rec[1]}\n\n{rec[2]}"
-            
-            return "📭 Hozircha barcha kitoblarni o'qib bo'ldingiz!"
-
-    async def force_migrate(self, library_data):
-        print("⏳ Force aligning database with LIBRARY_DATA...")
-        async with aiosqlite.connect(self.db_name) as db:
-            # 1. Clear books table to prevent duplicates/stale data
-            await db.execute("DELETE FROM books")
-            # 2. Reset AutoIncrement (optional but cleaner)
-            try:
-                await db.execute("DELETE FROM sqlite_sequence WHERE name='books'")
-            except Exception:
-                pass # Table might not exist yet if no autoincrement usage
-            
-            # 3. Insert all books
-            count = 0
-            for _, data in library_data.items():
+        """An unread book: co-read with the user's recent books, else like them,
+        else from their most-read category. None when nothing is personal."""
+        rec = self.recommender
+        similar = await self.similar_index()
+        while True:
+            catalog = await self._catalog()
+            if rec.version != catalog.version:
+                rec.build(catalog.books, catalog.version)
+            profile = rec.profile(user_id)
+            if profile is not None:
+                break
+            version = (self._reads_version, catalog.version)
+            query = "SELECT book_id FROM read_books WHERE user_id=? AND book_id IS NOT NULL GROUP BY book_id ORDER BY MAX(id)"
+            async with self.pool.reader() as db:
+                async with db.execute(query, (user_id,)) as cursor:
+                    book_ids = [row[0] for row in await cursor.fetchall()]
+            # A read or catalog change during the query makes the rows stale
+            if version == (self._reads_version, self.catalog.version):
+                profile = rec.load_profile(user_id, book_ids)
+                break
+        
+        if self.coreads is not None:
+            suggested = [other for other in self.coreads.suggest(profile.recent, profile.read) if catalog.get(other)]
+            if suggested:
+                _, title, author, desc, *_ = catalog.get(random.choice(suggested))
+                return f"👥 <b>Bu kitoblarni o'qiganlar buni ham o'qishgan:</b>\n\n📘 {title}\n✍️ {author}\n\n{desc}"
+        
+        # Content neighbours cover readers nobody else overlaps with yet
+        for read_id in reversed(profile.recent):
+            unread = [other for other in similar.get(read_id, ()) if other not in profile.read and catalog.get(other)]
+            if unread:
+                _, title, author, desc, *_ = catalog.get(random.choice(unread[:3]))
+                return f"📖 <b>Sizga yoqqan kitoblarga o'xshash:</b>\n\n📘 {title}\n✍️ {author}\n\n{desc}"
+        
+        picked = rec.pick(profile)
+        if picked is None or not picked[1]:
+            return None
+        _, title, author, desc, *_ = catalog.get(picked[0])
+        return f"🎯 <b>Siz uchun maxsus:</b>\n\n📘 {title}\n✍️ {author}\n\n{desc}"
+
+    async def next_in_bag(self, user_id, size):
+        """Advance the user's shuffle bag over a pool of `size`; returns (seed, cursor).
+
+        A used-up bag, or one dealt for a pool of another size, starts over
+        with a fresh seed."""
+        query = '''INSERT INTO recommendation_bags (user_id, seed, cursor, size) VALUES (?, ?, 1, ?) 
+            ON CONFLICT (user_id) DO UPDATE SET 
+                seed = CASE WHEN cursor >= excluded.size OR size != excluded.size THEN excluded.seed ELSE seed END, 
+                cursor = CASE WHEN cursor >= excluded.size OR size != excluded.size THEN 1 ELSE cursor + 1 END, 
+                size = excluded.size 
+            RETURNING seed, cursor - 1'''
+        async with self.pool.writer() as db:
+            async with db.execute(query, (user_id, random.getrandbits(31), size)) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+        return row
+
+    async def sync_catalog(self, library_data):
+        """Bring the books table in line with LIBRARY_DATA without a wipe.
+
+        Rows keep their ids (startquiz_{id} buttons stay valid); only books
+        whose content hash changed are written, all in one transaction, so
+        readers see either the old catalog or the new one.
+        """
+        print("⏳ Syncing catalog with LIBRARY_DATA...")
+        async with self.pool.writer() as db:
+            async with db.execute("SELECT id, title, source_key, content_hash, quiz_hash FROM books") as cursor:
+                existing = await cursor.fetchall()
+            by_key = {row[2]: row for row in existing if row[2] is not None}
+            # Rows from before source_key existed are adopted by title
+            by_title = {row[1]: row for row in existing if row[2] is None}
+
+            inserts, updates, kept, sources, written = [], [], set(), {}, []
+            requiz = set()  # source keys whose quiz changed; others keep their question rows
+            for key, data in library_data.items():
                 try:
                     q_json = json.dumps(data['quiz'], ensure_ascii=False)
                     cat = data.get('category', 'Badiiy')
-                    await db.execute("INSERT INTO books (title, author, desc, questions, category) VALUES (?, ?, ?, ?, ?)", 
-                                          (data['title'], data['author'], data['desc'], q_json, cat))
-                    count += 1
+                    values = (data['title'], data['author'], data['desc'], q_json, cat)
                 except Exception as e:
                     print(f"❌ Error adding book {data.get('title')}: {e}")
-            
+                    continue
+                digest, q_digest = book_hash(*values), quiz_hash(q_json)
+                sources[key] = (values, data['quiz'])
+                row = by_key.get(key) or by_title.pop(data['title'], None)
+                if row is None:
+                    inserts.append(values + (key, digest, q_digest))
+                    requiz.add(key)
+                    continue
+                kept.add(row[0])
+                if row[3] != digest or row[2] != key:
+                    updates.append(values + (key, digest, q_digest, row[0]))
+                    if row[4] != q_digest:
+                        requiz.add(key)
+            stale = [(row[0],) for row in by_key.values() if row[0] not in kept]
+
+            if inserts or updates or stale:
+                self._similar_stale = True
+                self.similar = None
+                self.content = None
+                await db.execute("BEGIN IMMEDIATE")
+                await db.executemany("UPDATE books SET title=?, author=?, desc=?, questions=?, category=?, source_key=?, content_hash=?, quiz_hash=? WHERE id=?", updates)
+                await db.executemany("INSERT INTO books (title, author, desc, questions, category, source_key, content_hash, quiz_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", inserts)
+                await db.executemany("DELETE FROM books WHERE id=?", stale)
+                await db.executemany("DELETE FROM quiz_questions WHERE book_id=?", stale)
+                await db.executemany("DELETE FROM books_fts WHERE rowid=?", stale)
+                changed = {row[5] for row in updates} | {row[5] for row in inserts}
+                async with db.execute("SELECT id, source_key FROM books WHERE source_key IS NOT NULL") as cursor:
+                    for book_id, key in await cursor.fetchall():
+                        if key in changed:
+                            values, quiz = sources[key]
+                            if key in requiz:
+                                await write_questions(db, book_id, quiz)
+                            await write_search_row(db, book_id, *values[:3])
+                            written.append((book_id, values))
+                await db.commit()
+                self.catalog.invalidate()
+                for (book_id,) in stale:
+                    self._unindex(("book", book_id))
+                    if self.coreads is not None:
+                        self.coreads.remove(book_id)
+                for book_id, values in written:
+                    self._index(("book", book_id), values[0], values[1])
+        print(f"✅ Catalog synced: {len(inserts)} added, {len(updates)} updated, {len(stale)} removed.")
+        return len(inserts), len(updates), len(stale)
+
+
+    # --- CLANS ---
+    async def join_clan(self, user_id, name):
+        """Move the user into `name` (created if new); returns the stored clan name."""
+        async with self.pool.writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("SELECT clan, quiz_points, books_read FROM users WHERE user_id=?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                await db.rollback()
+                return None
+            old, points, books_read = row
+            if old is not None:
+                await leave_clan_row(db, old, points, books_read)
+            query = '''INSERT INTO clans (name, members, points, books_read) VALUES (?, 1, ?, ?) 
+                ON CONFLICT (name) DO UPDATE SET members = members + 1, points = points + excluded.points, 
+                books_read = books_read + excluded.books_read RETURNING name'''
+            async with db.execute(query, (name, points, books_read)) as cursor:
+                clan = (await cursor.fetchone())[0]
+            await db.execute("UPDATE users SET clan=? WHERE user_id=?", (clan, user_id))
             await db.commit()
-        print(f"✅ Migration complete! {count} books added/updated.")
+        return clan
 
-    async def clear_library(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("DELETE FROM library_files")
+    async def leave_clan(self, user_id):
+        """Take the user out of their clan; returns its name, or None if they had none."""
+        async with self.pool.writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("SELECT clan, quiz_points, books_read FROM users WHERE user_id=?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row is None or row[0] is None:
+                await db.rollback()
+                return None
+            await leave_clan_row(db, *row)
+            await db.execute("UPDATE users SET clan=NULL WHERE user_id=?", (user_id,))
             await db.commit()
+        return row[0]
+
+    async def get_clan(self, name):
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT name, members, points, books_read FROM clans WHERE name=?", (name,)) as cursor:
+                return await cursor.fetchone()
 
+    async def get_clan_leaderboard(self, limit=10):
+        """Top clans as (name, members, points, books_read), read off idx_clans_points."""
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT name, members, points, books_read FROM clans ORDER BY points DESC LIMIT ?", (limit,)) as cursor:
+                return await cursor.fetchall()
 
     # --- TRACKER & READ BOOKS ---
     async def get_user_books_list(self, user_id):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute("SELECT book_name, date FROM read_books WHERE user_id=? ORDER BY date DESC", (user_id,)) as cursor:
                 return await cursor.fetchall()
 
-    async def add_read_book(self, user_id, book_name):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("INSERT INTO read_books (user_id, book_name, date) VALUES (?, ?, ?)", (user_id, book_name, datetime.date.today()))
-            await db.commit()
+    async def add_read_book(self, user_id, book_name, book_id=None):
+        # Bumped on both sides of the write so no history read overlaps it unnoticed
+        self._reads_version += 1
+        async def write(db):
+            previous = None
+            if self.coreads is not None and book_id is not None:
+                async with db.execute("SELECT DISTINCT book_id FROM read_books WHERE user_id=? AND book_id IS NOT NULL", (user_id,)) as cursor:
+                    previous = {row[0] for row in await cursor.fetchall()}
+            await db.execute("INSERT INTO read_books (user_id, book_name, date, book_id) VALUES (?, ?, ?, ?)", (user_id, book_name, datetime.date.today(), book_id))
+            async with db.execute("UPDATE users SET books_read = books_read + 1 WHERE user_id=? RETURNING clan", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row and row[0] is not None:
+                await db.execute("UPDATE clans SET books_read = books_read + 1 WHERE name=?", (row[0],))
+            return previous
+        previous = await self.writes.submit(write)
+        # books_read is shown on every board
+        for board in list(self.leaderboard_versions):
+            self._top_changed(board, user_id)
+        self._reads_version += 1
+        if book_id is not None:
+            self.recommender.note_read(user_id, book_id)
+        if previous is not None and self.coreads is not None:
+            self.coreads.add_read(book_id, previous)
             
     async def add_tracker_log(self, user_id, pages):
-        async with aiosqlite.connect(self.db_name) as db:
+        async def write(db):
             await db.execute("INSERT INTO tracker (user_id, pages, date) VALUES (?, ?, ?)", (user_id, pages, datetime.date.today()))
-            await db.commit()
+        await self.writes.submit(write)
 
     async def get_today_pages(self, user_id):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute("SELECT SUM(pages) FROM tracker WHERE user_id=? AND date=?", (user_id, datetime.date.today())) as cursor:
                 res = await cursor.fetchone()
                 return res[0] if res[0] else 0
 
     # --- LIBRARY FILES (PDFs) ---
     async def clear_library(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.writer() as db:
             await db.execute("DELETE FROM library_files")
             await db.commit()
+        self._pdf_count = 0
+        self.library_version += 1
+        if self.fuzzy is not None:
+            self.fuzzy.remove_where(lambda key: key[0] == "pdf")
+            self.prefix.remove_where(lambda key: key[0] == "pdf")
+            self._pdf_files.clear()
 
     async def add_pdf(self, title, file_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("INSERT INTO library_files (title, file_id) VALUES (?, ?)", (title, file_id))
+        async with self.pool.writer() as db:
+            cursor = await db.execute("INSERT INTO library_files (title, file_id) VALUES (?, ?)", (title, file_id))
             await db.commit()
+        if self._pdf_count is not None:
+            self._pdf_count += 1
+        self.library_version += 1
+        if self.fuzzy is not None:
+            self._pdf_files[cursor.lastrowid] = file_id
+        self._index(("pdf", cursor.lastrowid), title)
+
+    async def get_pdfs_count(self):
+        # Cached; only add_pdf and clear_library change it
+        if self._pdf_count is None:
+            async with self.pool.reader() as db:
+                async with db.execute("SELECT COUNT(*) FROM library_files") as cursor:
+                    self._pdf_count = (await cursor.fetchone())[0]
+        return self._pdf_count
+
+    async def get_pdfs_page(self, page, per_page=10, after=None, before=None):
+        """One page of (id, title) plus total_pages.
+
+        With `after` / `before` (the last / first id of the page on screen)
+        this is a keyset seek on the primary key; without them it falls back
+        to LIMIT/OFFSET for the given page.
+        """
+        if after is not None:
+            query, params = "SELECT id, title FROM library_files WHERE id > ? ORDER BY id LIMIT ?", (after, per_page)
+        elif before is not None:
+            query, params = "SELECT id, title FROM library_files WHERE id < ? ORDER BY id DESC LIMIT ?", (before, per_page)
+        else:
+            query, params = "SELECT id, title FROM library_files ORDER BY id LIMIT ? OFFSET ?", (per_page, (max(page, 1) - 1) * per_page)
+        async with self.pool.reader() as db:
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+        if before is not None:
+            rows.reverse()
+        total_pages = max(1, (await self.get_pdfs_count() + per_page - 1) // per_page)
+        return rows, total_pages
 
     async def get_all_pdfs(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute("SELECT id, title FROM library_files") as cursor:
                 return await cursor.fetchall()
             
     async def get_pdf_by_id(self, file_id):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute("SELECT file_id, title FROM library_files WHERE id=?", (file_id,)) as cursor:
                 return await cursor.fetchone()
 
     # --- MEMORY / OTHER ---
     async def add_memory(self, user_id, title, content, file_id, file_type):
-        async with aiosqlite.connect(self.db_name) as db:
+        async def write(db):
             await db.execute("INSERT INTO memory (user_id, title, content, file_id, file_type) VALUES (?, ?, ?, ?, ?)", (user_id, title, content, file_id, file_type))
-            await db.commit()
+        await self.writes.submit(write)
 
-    async def get_leaderboard(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            query = "SELECT fullname, quiz_points, streak, (SELECT COUNT(*) FROM read_books WHERE read_books.user_id = users.user_id) as book_count FROM users ORDER BY quiz_points DESC LIMIT 10"
-            async with db.execute(query) as cursor:
-                return await cursor.fetchall()
+    async def get_leaderboard(self, period="all"):
+        """Top users as (fullname, points, streak, books_read), from the snapshot.
+
+        `period` is "all", "week" or "month"; the windowed boards rank by
+        points earned in the current ISO week / calendar month.
+        """
+        if period == "all":
+            board = "all"
+            # Walks idx_users_points backwards; no per-user subquery
+            query = "SELECT user_id, fullname, quiz_points, streak, books_read FROM users ORDER BY quiz_points DESC LIMIT ?"
+            params = (self.leaderboard_size,)
+        else:
+            week, month = period_keys(datetime.date.today())
+            board = week if period == "week" else month
+            # Same shape, walking idx_points_periods_rank within one period
+            query = '''SELECT users.user_id, users.fullname, points_periods.points, users.streak, users.books_read 
+                FROM points_periods JOIN users ON users.user_id = points_periods.user_id 
+                WHERE points_periods.period = ? AND points_periods.points > 0 ORDER BY points_periods.points DESC LIMIT ?'''
+            params = (board, self.leaderboard_size)
+            # Boards of past weeks and months are never asked for again
+            for key in [k for k in self.leaderboard_versions if k not in ("all", week, month)]:
+                self._tops.pop(key, None)
+                del self.leaderboard_versions[key]
+        while board not in self._tops:
+            version = self.leaderboard_versions[board]
+            async with self.pool.reader() as db:
+                async with db.execute(query, params) as cursor:
+                    rows = await cursor.fetchall()
+            if version == self.leaderboard_versions[board]:
+                self._tops[board] = rows
+        return [row[1:] for row in self._tops[board]]
+
+    async def compact_ledger(self, keep_days=35):
+        """Drop ledger rows and week totals older than `keep_days`.
+
+        Month totals are written with every award, so they already hold the
+        dropped rows' points: history stays exact at month granularity.
+        """
+        cutoff = time.time() - keep_days * 86400
+        oldest_week, _ = period_keys(datetime.date.fromtimestamp(cutoff))
+        async with self.pool.writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute("DELETE FROM points_ledger WHERE ts < ?", (cutoff,))
+            rows = cursor.rowcount
+            cursor = await db.execute("DELETE FROM points_periods WHERE period LIKE 'w%' AND period < ?", (oldest_week,))
+            weeks = cursor.rowcount
+            await db.commit()
+        logging.info("Points ledger compacted: %s rows, %s week totals dropped", rows, weeks)
+        return rows, weeks
 
     async def get_all_users(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute("SELECT user_id FROM users") as cursor:
                 return await cursor.fetchall()
@@ -0,0 +1,113 @@
+import math
+from collections import defaultdict
+
+from search import normalize_text
+
+
+def trigrams(text):
+    """Padded character trigrams of every word in already-normalized text."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+class FuzzyIndex:
+    """Typo-tolerant lookup over short texts (titles, author names).
+
+    Every text is reduced to a script-normalized key (see search.normalize_text)
+    and split into trigrams with a posting set per trigram. A query scores each
+    text by the share of its own trigrams found there. Only the rarest
+    trigrams can introduce candidates: a text that matches at least
+    `min_score` of the query must contain one of them. The rest only confirm
+    candidates already found, and `max_candidates` caps the work either way.
+    """
+
+    def __init__(self, min_score=0.5, max_candidates=2000):
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.postings = defaultdict(set)  # trigram -> {entry, ...}
+        self.entries = {}  # entry -> (key, frozenset of trigrams)
+        self.texts = {}  # key -> original texts, as passed to add()
+        self._by_key = {}  # key -> [entry, ...]
+        self._next_entry = 0
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, key):
+        return key in self.texts
+
+    def add(self, key, *texts):
+        """Index `texts` under `key`, replacing whatever the key had before."""
+        self.remove(key)
+        self.texts[key] = texts
+        entries = self._by_key[key] = []
+        for text in texts:
+            grams = frozenset(trigrams(normalize_text(text)))
+            if not grams:
+                continue
+            entry = self._next_entry
+            self._next_entry += 1
+            self.entries[entry] = (key, grams)
+            entries.append(entry)
+            for gram in grams:
+                self.postings[gram].add(entry)
+
+    def remove(self, key):
+        if self.texts.pop(key, None) is None:
+            return
+        for entry in self._by_key.pop(key):
+            _, grams = self.entries.pop(entry)
+            for gram in grams:
+                posting = self.postings[gram]
+                posting.discard(entry)
+                if not posting:
+                    del self.postings[gram]
+
+    def remove_where(self, predicate):
+        for key in [key for key in self.texts if predicate(key)]:
+            self.remove(key)
+
+    def search(self, query, limit=10):
+        """Best matches as [(score, key), ...], highest first; score is 0..1."""
+        grams = trigrams(normalize_text(query))
+        if not grams:
+            return []
+        needed = math.ceil(len(grams) * self.min_score)
+        ordered = sorted(grams, key=lambda g: len(self.postings.get(g, ())))
+        seeds, checks = ordered[:len(grams) - needed + 1], ordered[len(grams) - needed + 1:]
+
+        hits = defaultdict(int)
+        for i, gram in enumerate(seeds):
+            posting = self.postings.get(gram, ())
+            room = self.max_candidates - len(hits)
+            if len(posting) > room:
+                # Out of room: take what fits, then only confirm candidates
+                for entry in posting:
+                    if room <= 0:
+                        break
+                    if entry not in hits:
+                        hits[entry] = 0
+                        room -= 1
+                checks = seeds[i:] + checks
+                break
+            for entry in posting:
+                hits[entry] += 1
+        for entry in hits:
+            own = self.entries[entry][1]
+            hits[entry] += sum(1 for gram in checks if gram in own)
+
+        best = {}
+        for entry, count in hits.items():
+            if count < needed:
+                continue
+            key, own = self.entries[entry]
+            # Ties go to the shorter text, i.e. the closer match
+            score = (count / len(grams), -len(own))
+            if score > best.get(key, (0, 0)):
+                best[key] = score
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(round(score[0], 3), key) for key, score in ranked]
@@ -0,0 +1,139 @@
+import time
+from array import array
+from collections import OrderedDict
+
+
+class QuizSession:
+    __slots__ = ('book_id', 'book_title', 'question_ids', 'q_idx', 'score', 'touched')
+
+    def __init__(self, book_id, book_title, question_ids, q_idx=0, score=0, touched=None):
+        self.book_id = book_id
+        self.book_title = book_title
+        self.question_ids = array('q', question_ids)
+        self.q_idx = q_idx
+        self.score = score
+        self.touched = touched or time.time()
+
+    @property
+    def total(self):
+        return len(self.question_ids)
+
+    def current_question(self):
+        if self.q_idx < len(self.question_ids):
+            return self.question_ids[self.q_idx]
+        return None
+
+
+class QuizSessionStore:
+    """Live quizzes keyed by user id, oldest-touched first.
+
+    Sessions keep only question ids; idle ones expire after `ttl` seconds
+    and the least recently used are dropped past `max_sessions`. Changes are
+    collected for take_changes() so they can be checkpointed to SQLite in
+    one batch and restored after a restart.
+    """
+
+    def __init__(self, ttl=1800, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._dirty = set()
+        self._dropped = set()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def start(self, user_id, book_id, book_title, question_ids):
+        session = QuizSession(book_id, book_title, question_ids)
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        self._dirty.add(user_id)
+        self._dropped.discard(user_id)
+        while len(self._sessions) > self.max_sessions:
+            old_id, _ = self._sessions.popitem(last=False)
+            self._drop(old_id)
+        return session
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        now = time.time()
+        if now - session.touched > self.ttl:
+            del self._sessions[user_id]
+            self._drop(user_id)
+            return None
+        session.touched = now
+        self._sessions.move_to_end(user_id)
+        self._dirty.add(user_id)
+        return session
+
+    def finish(self, user_id):
+        if self._sessions.pop(user_id, None) is not None:
+            self._dirty.discard(user_id)
+            self._dropped.add(user_id)
+
+    def _drop(self, user_id):
+        self.evicted += 1
+        self._dirty.discard(user_id)
+        self._dropped.add(user_id)
+
+    def evict_expired(self):
+        cutoff = time.time() - self.ttl
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.touched > cutoff:
+                break
+            del self._sessions[user_id]
+            self._drop(user_id)
+
+    def take_changes(self):
+        """Return (rows to upsert, user ids to delete) and reset the change log."""
+        rows = []
+        for user_id in self._dirty:
+            s = self._sessions[user_id]
+            ids = ','.join(map(str, s.question_ids))
+            rows.append((user_id, s.book_id, s.book_title, ids, s.q_idx, s.score, s.touched))
+        dropped = list(self._dropped)
+        self._dirty.clear()
+        self._dropped.clear()
+        return rows, dropped
+
+    def restore(self, rows):
+        cutoff = time.time() - self.ttl
+        for user_id, book_id, book_title, ids, q_idx, score, touched in sorted(rows, key=lambda r: r[6]):
+            if touched <= cutoff:
+                self._dropped.add(user_id)
+                continue
+            question_ids = [int(q) for q in ids.split(',') if q]
+            self._sessions[user_id] = QuizSession(book_id, book_title, question_ids, q_idx, score, touched)
+        return len(self._sessions)
+
+
+class RenderCache:
+    """Small LRU map used for pre-rendered payloads that can be rebuilt on a miss."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        return self._items.pop(key, None)
@@ -0,0 +1,100 @@
+from collections import defaultdict
+
+
+class RankIndex:
+    """Order-statistic index over users' quiz points.
+
+    A Fenwick tree counts users per points value, so "how many users have
+    more points than p" and "which value holds the k-th user" are both
+    O(log max_points). Users sharing a value live in one bucket; tied users
+    share a rank (1 + the number of users strictly ahead).
+    """
+
+    def __init__(self):
+        self.points = {}  # user_id -> points
+        self.buckets = defaultdict(set)  # points -> {user_id, ...}
+        self._size = 1024  # tree covers points 0.._size-1, doubled as needed
+        self._tree = [0] * (self._size + 1)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _grow(self, points):
+        size = self._size
+        while points >= size:
+            size *= 2
+        if size != self._size:
+            counts = [(p, len(users)) for p, users in self.buckets.items() if users]
+            self._size = size
+            self._tree = [0] * (size + 1)
+            for p, n in counts:
+                self._add(p, n)
+
+    def _add(self, points, delta):
+        i = points + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _count_upto(self, points):
+        """Users with at most `points` points."""
+        i, total = min(points + 1, self._size), 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _kth(self, k):
+        """Smallest points value with at least k users at or below it (1-based k)."""
+        pos, step = 0, self._size
+        while step:
+            nxt = pos + step
+            if nxt <= self._size and self._tree[nxt] < k:
+                pos = nxt
+                k -= self._tree[nxt]
+            step //= 2
+        return pos  # tree index pos + 1 holds points value pos
+
+    def load(self, rows):
+        for user_id, points in rows:
+            self.set(user_id, points)
+
+    def set(self, user_id, points):
+        points = max(0, points or 0)
+        old = self.points.get(user_id)
+        if old == points:
+            return
+        if old is not None:
+            self.buckets[old].discard(user_id)
+            if not self.buckets[old]:
+                del self.buckets[old]
+            self._add(old, -1)
+        self._grow(points)
+        self.points[user_id] = points
+        self.buckets[points].add(user_id)
+        self._add(points, 1)
+
+    def rank(self, user_id):
+        """(rank, total) for the user, or None if unknown."""
+        points = self.points.get(user_id)
+        if points is None:
+            return None
+        total = len(self.points)
+        return total - self._count_upto(points) + 1, total
+
+    def neighbors(self, user_id):
+        """((user_id, points) just ahead, (user_id, points) just behind); None at the ends."""
+        points = self.points.get(user_id)
+        if points is None:
+            return None, None
+        total = len(self.points)
+        below_count = self._count_upto(points - 1) if points > 0 else 0
+        at_or_below = self._count_upto(points)
+        above = below = None
+        if at_or_below < total:
+            p = self._kth(at_or_below + 1)
+            above = (next(iter(self.buckets[p])), p)
+        if below_count > 0:
+            p = self._kth(below_count)
+            below = (next(iter(self.buckets[p])), p)
+        return above, below
@@ -0,0 +1,319 @@
+import heapq
+import logging
+import math
+import random
+import re
+from collections import Counter, OrderedDict, defaultdict
+from itertools import combinations
+
+from search import normalize_text
+
+
+class ReadProfile:
+    __slots__ = ('read', 'categories', 'recent')
+
+    def __init__(self):
+        self.read = set()  # book ids
+        self.categories = Counter()
+        self.recent = []  # last few distinct reads, oldest first
+
+    def add(self, book_id, category, keep_recent=20):
+        if book_id in self.read:
+            return
+        self.read.add(book_id)
+        self.categories[category] += 1
+        self.recent.append(book_id)
+        del self.recent[:-keep_recent]
+
+    def favorite(self):
+        top = self.categories.most_common(1)
+        return top[0][0] if top else None
+
+
+class Recommender:
+    """Unread-book sampling over precomputed candidate arrays.
+
+    The catalog is split once into an id array per category (plus one for
+    all books). A pick probes a few random slots of the array and skips
+    books the user has read; only if those all hit read books does it walk
+    the array once from a random start. The cost depends on the catalog,
+    never on how many books the user has read. Read profiles are kept for
+    the most recently active users.
+    """
+
+    def __init__(self, max_profiles=5000, probes=8):
+        self.max_profiles = max_profiles
+        self.probes = probes
+        self.version = None
+        self.categories = {}  # book id -> category
+        self.by_category = {}  # category -> [book id, ...]
+        self.all_ids = []
+        self._profiles = OrderedDict()
+
+    def build(self, books, version):
+        """Index catalog rows (id, title, author, desc, category, ...) and drop profiles."""
+        self.categories = {row[0]: row[4] for row in books}
+        self.by_category = {}
+        for book_id, category in self.categories.items():
+            self.by_category.setdefault(category, []).append(book_id)
+        self.all_ids = list(self.categories)
+        self._profiles.clear()
+        self.version = version
+
+    def profile(self, user_id):
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self._profiles.move_to_end(user_id)
+        return profile
+
+    def load_profile(self, user_id, book_ids):
+        profile = ReadProfile()
+        for book_id in book_ids:
+            if book_id in self.categories:
+                profile.add(book_id, self.categories[book_id])
+        self._profiles[user_id] = profile
+        while len(self._profiles) > self.max_profiles:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def note_read(self, user_id, book_id):
+        profile = self._profiles.get(user_id)
+        if profile is not None and book_id in self.categories:
+            profile.add(book_id, self.categories[book_id])
+
+    def _sample(self, ids, read):
+        n = len(ids)
+        if not n:
+            return None
+        for _ in range(self.probes):
+            book_id = ids[random.randrange(n)]
+            if book_id not in read:
+                return book_id
+        start = random.randrange(n)
+        for i in range(n):
+            book_id = ids[(start + i) % n]
+            if book_id not in read:
+                return book_id
+        return None
+
+    def pick(self, profile):
+        """(book_id, from_favorite_category), or None when everything is read."""
+        favorite = profile.favorite()
+        if favorite is not None:
+            book_id = self._sample(self.by_category.get(favorite, ()), profile.read)
+            if book_id is not None:
+                return book_id, True
+        book_id = self._sample(self.all_ids, profile.read)
+        return (book_id, False) if book_id is not None else None
+
+
+class CoReadIndex:
+    """Item-item co-occurrence ("readers also read") with top-K neighbours.
+
+    pairs[a][b] counts users who read both a and b; a neighbour's score is
+    the cosine pairs[a][b] / sqrt(readers[a] * readers[b]). build() does the
+    full batch pass; add_read() applies one new read and re-ranks only the
+    books it touched, so scores of untouched books drift slightly until
+    the next build.
+    """
+
+    def __init__(self, k=10, max_history=200):
+        self.k = k
+        self.max_history = max_history  # most recent books counted per user in build()
+        self.pairs = defaultdict(Counter)
+        self.readers = Counter()
+        self.neighbors = {}  # book id -> [(score, book id), ...] best first
+
+    def build(self, histories):
+        """`histories`: one list of distinct book ids per user, oldest first."""
+        self.pairs = defaultdict(Counter)
+        self.readers = Counter()
+        self.neighbors = {}
+        for books in histories:
+            books = books[-self.max_history:]
+            self.readers.update(books)
+            for a, b in combinations(books, 2):
+                self.pairs[a][b] += 1
+                self.pairs[b][a] += 1
+        for book_id in self.pairs:
+            self._rank(book_id)
+
+    def add_read(self, book_id, previous):
+        """Apply a first read of `book_id` by a user who had read `previous`."""
+        if book_id in previous:
+            return
+        self.readers[book_id] += 1
+        for other in previous:
+            self.pairs[other][book_id] += 1
+            self.pairs[book_id][other] += 1
+        for other in previous:
+            self._rank(other)
+        self._rank(book_id)
+
+    def remove(self, book_id):
+        """Forget a book that left the catalog and re-rank its neighbours."""
+        self.readers.pop(book_id, None)
+        self.neighbors.pop(book_id, None)
+        for other in self.pairs.pop(book_id, {}):
+            self.pairs[other].pop(book_id, None)
+            self._rank(other)
+
+    def _rank(self, book_id):
+        row = self.pairs.get(book_id)
+        if not row:
+            self.neighbors.pop(book_id, None)
+            return
+        readers = self.readers[book_id]
+        scored = ((count / math.sqrt(readers * self.readers[other]), other) for other, count in row.items())
+        self.neighbors[book_id] = heapq.nlargest(self.k, scored)
+
+    def suggest(self, recent, read, limit=3):
+        """Unread books most co-read with `recent`, best first."""
+        scores = Counter()
+        for book_id in recent:
+            for score, other in self.neighbors.get(book_id, ()):
+                if other not in read:
+                    scores[other] += score
+        return [book_id for book_id, _ in scores.most_common(limit)]
+
+
+# "📕 <b>«Title» — Author</b>\nOne line about it."
+_RECOMMENDATION = re.compile(r"\S+ <b>«(?P<title>[^«»]+)» — (?P<author>[^<]+)</b>\n[^\n<]+")
+
+
+def recommendation_pool(entries):
+    """Well-formed entries, first of each (title, author), in their original order."""
+    pool, seen = [], set()
+    for entry in entries:
+        match = _RECOMMENDATION.fullmatch(entry)
+        if match is None:
+            logging.warning("Skipping malformed recommendation: %r", entry[:60])
+            continue
+        key = (normalize_text(match["title"]), normalize_text(match["author"]))
+        if key in seen:
+            logging.warning("Skipping duplicate recommendation: %s", match["title"])
+            continue
+        seen.add(key)
+        pool.append(entry)
+    return tuple(pool)
+
+
+class ShuffleBag:
+    """Hands out every entry of a fixed pool once before any repeats.
+
+    A user's bag is only (seed, cursor): the entry at position `cursor` of
+    the seed's permutation of the pool. The permutation is a small keyed
+    Feistel network over the next power of two, walking past slots beyond
+    the pool, so a pick is O(1) and nothing is shuffled or kept per user.
+    """
+
+    def __init__(self, entries, rounds=4):
+        self.entries = tuple(entries)
+        self.rounds = rounds
+        self._half = (max(2, (len(self.entries) - 1).bit_length()) + 1) // 2
+        self._mask = (1 << self._half) - 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _round(self, seed, r, x):
+        h = (x * 0x9E3779B1 + seed * 0x85EBCA77 + r * 0xC2B2AE3D) & 0xFFFFFFFF
+        h ^= h >> 15
+        h = (h * 0x2C1B3C6D) & 0xFFFFFFFF
+        h ^= h >> 12
+        return h & self._mask
+
+    def position(self, seed, cursor):
+        """Where the seed's permutation sends `cursor` (0 <= cursor < len)."""
+        x = cursor
+        while True:
+            left, right = x >> self._half, x & self._mask
+            for r in range(self.rounds):
+                left, right = right, left ^ self._round(seed, r, right)
+            x = (left << self._half) | right
+            if x < len(self.entries):
+                return x
+
+    def pick(self, seed, cursor):
+        return self.entries[self.position(seed, cursor)]
+
+
+# Words too common in descriptions and quiz questions to say anything about a book
+STOPWORDS = {
+    "va", "bu", "bilan", "uchun", "ham", "qanday", "nima", "kim", "qaysi", "edi",
+    "bir", "deb", "emas", "yoki", "lekin", "u", "shu", "uning", "nega",
+    "qachon", "qayerda", "muallif", "asar", "asarda", "kitob", "kitobda", "haqida",
+}
+
+
+def content_terms(text):
+    return [w for w in normalize_text(text).split() if len(w) > 2 and w not in STOPWORDS and not w.isdigit()]
+
+
+class ContentIndex:
+    """TF-IDF similar-books index over description and quiz text.
+
+    Vectors are sparse dicts (term -> weight), L2-normalized, with an
+    inverted index so a book is only compared with books sharing a term.
+    add() scores one new book with the current IDF and splices it into
+    the others' top-K lists; build() recomputes everything.
+    """
+
+    def __init__(self, k=5):
+        self.k = k
+        self.df = Counter()
+        self.counts = {}  # book id -> Counter of terms
+        self.vectors = {}  # book id -> {term: weight}
+        self.postings = defaultdict(dict)  # term -> {book id: weight}
+        self.neighbors = {}  # book id -> [(score, book id), ...] best first
+
+    def _vector(self, counts):
+        n = len(self.counts)
+        vec = {t: (1 + math.log(c)) * (math.log((1 + n) / (1 + self.df[t])) + 1) for t, c in counts.items()}
+        norm = math.sqrt(sum(w * w for w in vec.values())) or 1.0
+        return {t: w / norm for t, w in vec.items()}
+
+    def _scores(self, book_id):
+        scores = Counter()
+        for term, weight in self.vectors[book_id].items():
+            for other, w in self.postings[term].items():
+                if other != book_id:
+                    scores[other] += weight * w
+        return scores
+
+    def _index(self, book_id):
+        for term, weight in self.vectors[book_id].items():
+            self.postings[term][book_id] = weight
+
+    def build(self, texts):
+        """`texts`: {book id: text}. Returns every book id."""
+        self.counts = {book_id: Counter(content_terms(text)) for book_id, text in texts.items()}
+        self.df = Counter(t for counts in self.counts.values() for t in counts)
+        self.vectors = {book_id: self._vector(counts) for book_id, counts in self.counts.items()}
+        self.postings = defaultdict(dict)
+        for book_id in self.vectors:
+            self._index(book_id)
+        self.neighbors = {}
+        for book_id in self.vectors:
+            top = self._scores(book_id).most_common(self.k)
+            self.neighbors[book_id] = [(score, other) for other, score in top]
+        return set(self.vectors)
+
+    def add(self, book_id, text):
+        """Index one new book; returns the ids whose neighbour lists changed."""
+        counts = Counter(content_terms(text))
+        self.counts[book_id] = counts
+        self.df.update(counts.keys())
+        self.vectors[book_id] = self._vector(counts)
+        self._index(book_id)
+        scores = self._scores(book_id)
+        self.neighbors[book_id] = [(score, other) for other, score in scores.most_common(self.k)]
+        changed = {book_id}
+        for other, score in scores.items():
+            top = self.neighbors.setdefault(other, [])
+            if len(top) < self.k or score > top[-1][0]:
+                top.append((score, book_id))
+                top.sort(reverse=True)
+                del top[self.k:]
+                changed.add(other)
+        return changed
@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+# Typed callback payloads, parsed once before the handler runs
+PageNav = namedtuple('PageNav', ['action', 'page', 'cursor'])
+
+
+def parse_int(payload):
+    return int(payload)
+
+
+def parse_flag(payload):
+    return payload == "1"
+
+
+def parse_choice(*choices):
+    # A parser that accepts only the given words, e.g. parse_choice("week", "month")
+    def parser(payload):
+        if payload not in choices:
+            raise ValueError(f"unexpected payload: {payload}")
+        return payload
+    return parser
+
+
+def parse_page(payload):
+    # "next_3" or, with a keyset cursor, "next_3_57"
+    parts = payload.split("_")
+    if len(parts) not in (2, 3) or parts[0] not in ("prev", "next"):
+        raise ValueError(f"bad page payload: {payload}")
+    cursor = int(parts[2]) if len(parts) == 3 else None
+    return PageNav(parts[0], int(parts[1]), cursor)
+
+
+class Router:
+    """Constant-cost dispatch for menu buttons and callback data.
+
+    Menu buttons are an exact dict lookup on message text. Callback data is
+    matched against a character trie of registered prefixes (the longest
+    one wins), so the cost depends on the prefix length, not on how many
+    handlers exist. The rest of the data is parsed once into a typed value.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+
+    def text(self, text):
+        def decorator(fn):
+            self.exact[text] = fn
+            return fn
+        return decorator
+
+    def callback(self, prefix, parser=None):
+        def decorator(fn):
+            node = self.trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[None] = (prefix, fn, parser)
+            return fn
+        return decorator
+
+    def match_text(self, text):
+        return self.exact.get(text)
+
+    def match_callback(self, data):
+        node, found = self.trie, None
+        for ch in data:
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+        if found is None:
+            return None
+        prefix, fn, parser = found
+        if parser is None:
+            return fn, None
+        return fn, parser(data[len(prefix):])
@@ -0,0 +1,137 @@
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+# Uzbek Latin writes o‘ / g‘ and the tutuq belgisi with whichever apostrophe
+# the keyboard had: ' ‘ ’ ` ʻ ʼ. They are dropped so "O‘tkir", "O'tkir" and
+# "Otkir" all index and query as the same word.
+APOSTROPHES = "'‘’`ʻʼ´"
+_APOSTROPHE_TABLE = {ord(ch): None for ch in APOSTROPHES}
+_WORD = re.compile(r"\w+")
+
+# Uzbek Cyrillic (plus the Russian-only letters) to the official Latin
+# alphabet, so titles and queries in either script share one key.
+CYRILLIC_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo",
+    "ж": "j", "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "x", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "'",
+    "ы": "i", "ь": "", "э": "e", "ю": "yu", "я": "ya", "ў": "o'", "қ": "q",
+    "ғ": "g'", "ҳ": "h",
+}
+_CYRILLIC_TABLE = {ord(k): v for k, v in CYRILLIC_TO_LATIN.items()}
+# "е" is "ye" at the start of a word and after a vowel or hard sign (Ерлан, поезд)
+_IOTATED_E = re.compile(r"(?:(?<=[аеёиоуэюяўъь])|(?<!\w))е")
+
+
+def to_latin(text):
+    """Transliterate lowercase Cyrillic to Uzbek Latin; other text is left as is."""
+    return _IOTATED_E.sub("ye", text).translate(_CYRILLIC_TABLE)
+
+
+def normalize_text(text):
+    if not text:
+        return ""
+    text = to_latin(unicodedata.normalize("NFKC", text).lower())
+    return text.translate(_APOSTROPHE_TABLE)
+
+
+def fts_query(text):
+    """Turn user input into an FTS5 MATCH expression.
+
+    Finished words must match whole tokens; only the last one is a prefix,
+    since the user may still be typing it.
+    """
+    words = _WORD.findall(normalize_text(text))
+    if not words:
+        return ""
+    return " ".join([f'"{w}"' for w in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+class PrefixIndex:
+    """As-you-type lookup: every query word must be a prefix of some word.
+
+    Normalized words are kept as one sorted list of (word, key) pairs, so a
+    prefix is two bisects and a slice. New pairs are merged in on the next
+    lookup: one by one for a few, with a single sort after a bulk build.
+    Ranked key lists are memoized per query (paging re-reads them) and
+    dropped on any change.
+    """
+
+    def __init__(self, max_cached=256):
+        self.max_cached = max_cached
+        self._entries = []  # sorted [(word, key), ...]
+        self._pending = []  # added since the last sort
+        self._words = {}  # key -> set of words
+        self._heads = {}  # key -> normalized first text, for ranking
+        self._ranked = OrderedDict()
+
+    def __len__(self):
+        return len(self._words)
+
+    def add(self, key, *texts):
+        self.remove(key)
+        words = set()
+        for text in texts:
+            words.update(_WORD.findall(normalize_text(text)))
+        self._pending.extend((word, key) for word in words)
+        self._words[key] = words
+        self._heads[key] = normalize_text(texts[0]) if texts else ""
+        self._ranked.clear()
+
+    def remove(self, key):
+        words = self._words.pop(key, None)
+        if words is None:
+            return
+        self._merge()
+        for word in words:
+            del self._entries[bisect_left(self._entries, (word, key))]
+        del self._heads[key]
+        self._ranked.clear()
+
+    def remove_where(self, predicate):
+        for key in [key for key in self._words if predicate(key)]:
+            self.remove(key)
+
+    def _merge(self):
+        if len(self._pending) > 64:
+            self._entries.extend(self._pending)
+            self._entries.sort()
+        else:
+            for entry in self._pending:
+                insort(self._entries, entry)
+        self._pending.clear()
+
+    def _rank(self, words):
+        phrase = " ".join(words)
+        ranked = self._ranked.get(phrase)
+        if ranked is not None:
+            self._ranked.move_to_end(phrase)
+            return ranked
+        if not words:
+            matches = self._words.keys()
+        else:
+            self._merge()
+            matches = None
+            # Longest words first: they have the narrowest ranges
+            for word in sorted(words, key=len, reverse=True):
+                lo = bisect_left(self._entries, (word,))
+                hi = bisect_left(self._entries, (word + "\uffff",))
+                found = {key for _, key in self._entries[lo:hi]}
+                matches = found if matches is None else matches & found
+                if not matches:
+                    break
+        # Titles that start with the query come first, then by key order
+        ranked = sorted(matches, key=lambda key: (not self._heads[key].startswith(phrase), key))
+        self._ranked[phrase] = ranked
+        if len(self._ranked) > self.max_cached:
+            self._ranked.popitem(last=False)
+        return ranked
+
+    def search(self, query, offset=0, limit=50):
+        """Return (keys, next_offset); next_offset is None on the last page."""
+        ranked = self._rank(_WORD.findall(normalize_text(query)))
+        page = ranked[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(ranked) else None
+        return page, next_offset
@@ -49,7 +49,7 @@ def generate_profile_card(fullname, rank, points, progress_percent, avatar_bytes
     # 5. Draw Text (Shifted right to accommodate avatar)
     text_x = 250 
     draw.text((text_x, 80), f"{fullname[:20]}", font=font_large, fill=(255, 255, 255))
-    draw.text((text_x, 160), f"🏅 Unvon: {rank}", font=font_medium, fill=(200, 200, 200))
+    draw.text((text_x, 160), f"🏅 O'rin: {rank}", font=font_medium, fill=(200, 200, 200))
     draw.text((text_x, 215), f"🧠 Zakovat: {points}", font=font_medium, fill=(200, 200, 200))
 
     # 6. Draw Progress Bar
@@ -64,7 +64,7 @@ def generate_profile_card(fullname, rank, points, progress_percent, avatar_bytes
     if fill_w > bar_w: fill_w = bar_w
     draw.rectangle([(bar_x, bar_y), (bar_x + fill_w, bar_y + bar_h)], fill=(0, 255, 100)) # Green fill
 
-    draw.text((bar_x, bar_y - 40), f"Daraja o'sishi: {int(progress_percent * 100)}%", font=font_small, fill=(255, 255, 255))
+    draw.text((bar_x, bar_y - 40), f"Keyingi o'ringacha: {int(progress_percent * 100)}%", font=font_small, fill=(255, 255, 255))
 
     # 7. Save to BytesIO
     output = io.BytesIO()